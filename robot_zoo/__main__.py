@@ -1,85 +1,143 @@
 #!/usr/bin/env python
 
+import os
 import time
 import threading
 import logging
 
 from . import twitter
 from . import pycron
+from . import bot
 
-from .bot import casio_f91w as _casio_f91w
-from .bot import deoldehove as _deoldehove
-from .bot import hetluchtalarm as _hetluchtalarm
-from .bot import y2k38warning as _y2k38warning
-from .bot import maanfase as _maanfase
+bots = {}                                   # name -> bot, for the bots that were created
 
 def parse_args():
     import argparse
+    import datetime
+    def bot_names(s):
+        names = s.split(',')
+        for name in names:
+            if name not in bot.REGISTRY:
+                raise argparse.ArgumentTypeError(f"unknown bot {name!r} (choose from {', '.join(bot.REGISTRY)})")
+        return names
     parser = argparse.ArgumentParser()
     parser.add_argument('-q', '--quiet',   action='store_true', default=False, help='only output errors')
     parser.add_argument('-d', '--debug',   action='store_true', default=False, help='output everything')
     parser.add_argument('-n', '--no-time', action='store_true', default=False, help="don't output date/time in logging")
-    return parser.parse_args()
+    parser.add_argument('--bots',          type=bot_names, default=os.environ.get('ROBOT_ZOO_BOTS', ','.join(bot.REGISTRY)), help='comma-separated bots to run (default all, or $ROBOT_ZOO_BOTS)')
+    parser.add_argument('--asyncio',       action='store_true', default=False, help='run the runners, executor and api calls on one event loop')
+    commands = parser.add_subparsers(dest='command')
+    schedule = commands.add_parser('schedule', help='print what would be posted, without posting')
+    schedule.add_argument('--from',    dest='start', type=datetime.datetime.fromisoformat, default=datetime.datetime.now(), help='start (ISO 8601, default now)')
+    schedule.add_argument('--to',      dest='end',   type=datetime.datetime.fromisoformat, default=None, help='end, exclusive (ISO 8601, default one day after start)')
+    schedule.add_argument('--summary', action='store_true', default=False, help='only print the number of posts per bot')
+    args = parser.parse_args()
+    if args.command == 'schedule' and args.end is None:
+        args.end = args.start + datetime.timedelta(days=1)
+    return args
+
+def rules(*table):
+    # the (rule, 'bot.method') entries of a table whose bot was created, with the
+    # method looked up on that bot
+    for (rule, action) in table:
+        (name, method) = action.split('.')
+        if name in bots:
+            yield (rule, getattr(bots[name], method))
 
 class RobotZooCET(pycron.CronRunner):
     def __init__(self, name, executor):
-        super(RobotZooCET, self).__init__(name, time.localtime, executor,
+        super(RobotZooCET, self).__init__(name, time.localtime, executor, *rules(
             #   -------- -------- -------- -------- -------- -------- --------
             #   second   minute   hour     monthday month    year     weekday
             #   -------- -------- -------- -------- -------- -------- --------
 
             #   ........ ........ ........ ........ ........ ........ ......... @casio_f91w
-              ('*        00       *        *        *        *        *       ', casio_f91w.send_beep)
-            # ('01       00-59/02 *        *        *        *        *       ', casio_f91w.handle_mentions)
-            # ('02       *        *        *        *        *        *       ', casio_f91w.send_alarms)
+              ('*        00       *        *        *        *        *       ', 'casio_f91w.send_beep')
+            # ('01       00-59/02 *        *        *        *        *       ', 'casio_f91w.handle_mentions')
+            # ('02       *        *        *        *        *        *       ', 'casio_f91w.send_alarms')
 
             #   ........ ........ ........ ........ ........ ........ ........  @deoldehove
-            , ('*        00-59/30 *        10-12    sep      2010     *       ', deoldehove.sound_clock_lwd_culinair)
-            , ('*        00-59/30 *        09-11    sep      2011     *       ', deoldehove.sound_clock_lwd_culinair)
-            , ('*        00-59/30 *        07-09    sep      2012     *       ', deoldehove.sound_clock_lwd_culinair)
+            , ('*        00-59/30 *        10-12    sep      2010     *       ', 'deoldehove.sound_clock_lwd_culinair')
+            , ('*        00-59/30 *        09-11    sep      2011     *       ', 'deoldehove.sound_clock_lwd_culinair')
+            , ('*        00-59/30 *        07-09    sep      2012     *       ', 'deoldehove.sound_clock_lwd_culinair')
 
-            , ('*        00-59/30 09-23    13       aug      2011     *       ', deoldehove.sound_clock_into_the_grave)
-            , ('*        00-59/30 00-08    14       aug      2011     *       ', deoldehove.sound_clock_into_the_grave)
+            , ('*        00-59/30 09-23    13       aug      2011     *       ', 'deoldehove.sound_clock_into_the_grave')
+            , ('*        00-59/30 00-08    14       aug      2011     *       ', 'deoldehove.sound_clock_into_the_grave')
 
-            , ('*        00-59/30 09-23    11       aug      2012     *       ', deoldehove.sound_clock_into_the_grave)
-            , ('*        00-59/30 00-08    12       aug      2012     *       ', deoldehove.sound_clock_into_the_grave)
+            , ('*        00-59/30 09-23    11       aug      2012     *       ', 'deoldehove.sound_clock_into_the_grave')
+            , ('*        00-59/30 00-08    12       aug      2012     *       ', 'deoldehove.sound_clock_into_the_grave')
 
-            , ('*        00-59/30 09-23    10       aug      2013     *       ', deoldehove.sound_clock_into_the_grave)
-            , ('*        00-59/30 00-08    11       aug      2013     *       ', deoldehove.sound_clock_into_the_grave)
+            , ('*        00-59/30 09-23    10       aug      2013     *       ', 'deoldehove.sound_clock_into_the_grave')
+            , ('*        00-59/30 00-08    11       aug      2013     *       ', 'deoldehove.sound_clock_into_the_grave')
 
-            , ('*        00-59/30 *        *        *        *        *       ', deoldehove.sound_clock)
+            , ('*        00-59/30 *        *        *        *        *       ', 'deoldehove.sound_clock')
 
             #   ........ ........ ........ ........ ........ ........ ........  @hetluchtalarm
-            , ('*        00       12       01-07    *        *        mon     ', hetluchtalarm.sound_alarm)
+            , ('*        00       12       01-07    *        *        mon     ', 'hetluchtalarm.sound_alarm')
 
-            #   ........ ........ ........ ........ ........ ........ ........  @maanfase
-            , ('00       *        *        *        *        *        *       ', maanfase.post_phase)
+            #   ........ ........ ........ ........ ........ ........ ........  @maanfase (posts from timers, see start_timers())
+            , ('30       00       03       *        *        *        *       ', 'maanfase.warm_up')
 
             #   -------- -------- -------- -------- -------- -------- --------
-        )
+        ))
 
 class RobotZooUTC(pycron.CronRunner):
     def __init__(self, name, executor):
-        super(RobotZooUTC, self).__init__(name, time.gmtime, executor,
+        super(RobotZooUTC, self).__init__(name, time.gmtime, executor, *rules(
             #   -------- -------- -------- -------- -------- --------- --------
             #   second   minute   hour     monthday month    year      weekday
             #   -------- -------- -------- -------- -------- --------- --------
 
             #   ........ ........ ........ ........ ........ ......... ........  @y2k38warning (2038-01-19 03:14:07)
-              ('07       14       03       19       01       2013-2036 *       ', y2k38warning.yearly)
-            , ('07       14       03       19       01-11    2037      *       ', y2k38warning.monthly)
-            , ('07       14       03       19-31    12       2037      *       ', y2k38warning.daily)
-            , ('07       14       03       01-17    01       2038      *       ', y2k38warning.daily)
-            , ('07       14       03-23    18       01       2038      *       ', y2k38warning.hourly)
-            , ('07       14       00-01    19       01       2038      *       ', y2k38warning.hourly)
-            , ('07       14-59    02       19       01       2038      *       ', y2k38warning.every_minute)
-            , ('07       00-13    03       19       01       2038      *       ', y2k38warning.every_minute)
-            , ('07-59    13       03       19       01       2038      *       ', y2k38warning.every_second)
-            , ('00-06    14       03       19       01       2038      *       ', y2k38warning.every_second)
-            , ('07       14       03       19       01       2038      *       ', y2k38warning.zero)
+              ('07       14       03       19       01       2013-2036 *       ', 'y2k38warning.yearly')
+            , ('07       14       03       19       01-11    2037      *       ', 'y2k38warning.monthly')
+            , ('07       14       03       19-31    12       2037      *       ', 'y2k38warning.daily')
+            , ('07       14       03       01-17    01       2038      *       ', 'y2k38warning.daily')
+            , ('07       14       03-23    18       01       2038      *       ', 'y2k38warning.hourly')
+            , ('07       14       00-01    19       01       2038      *       ', 'y2k38warning.hourly')
+            , ('07       14-59    02       19       01       2038      *       ', 'y2k38warning.every_minute')
+            , ('07       00-13    03       19       01       2038      *       ', 'y2k38warning.every_minute')
+            , ('07-59    13       03       19       01       2038      *       ', 'y2k38warning.every_second')
+            , ('00-06    14       03       19       01       2038      *       ', 'y2k38warning.every_second')
+            , ('07       14       03       19       01       2038      *       ', 'y2k38warning.zero')
             #   -------- -------- -------- -------- -------- --------- --------
-        )
+        ))
+
+def create_bots(names=bot.REGISTRY):
+    global johndoeveloper
+    johndoeveloper = twitter.TwitterAPI('johndoeveloper')
+    for name in names:
+        bots[name] = bot.create(name)
+
+def create_runners(queue):
+    # a table left without rules by --bots isn't started
+    return [ runner for runner in (RobotZooCET('cron_cet', queue), RobotZooUTC('cron_utc', queue)) if runner.rules ]
 
+def start_timers(runners, years=None):
+    # bots that post from one-shot timers instead of rules register them here:
+    # from now on, or for the dry run every timer of the given years
+    for runner in runners:
+        if isinstance(runner, RobotZooCET) and 'maanfase' in bots:
+            if years is None:
+                bots['maanfase'].schedule(time.localtime(), runner)
+            else:
+                for year in years:
+                    bots['maanfase'].add_timers(year, runner)
+
+def schedule(start, end, summary=False):
+    crons = create_runners(None)
+    start_timers(crons, range(start.year, end.year + 1))
+    for cron in crons:
+        counts = {}
+        for (dt, bot, action) in cron.upcoming(start, end):
+            if action.__name__ in getattr(bot, 'HOUSEKEEPING', ()):
+                continue
+            name = bot.name if bot else ''
+            counts[name] = counts.get(name, 0) + 1
+            if not summary:
+                print(f"{dt:%Y-%m-%d %H:%M:%S} {cron.name:8} {name:16} {action.__name__}")
+        for (name, count) in sorted(counts.items()):
+            print(f"{cron.name:8} {name:16} {count:9} firings from {start:%Y-%m-%d %H:%M:%S} to {end:%Y-%m-%d %H:%M:%S}")
 
 if __name__ == '__main__':
 
@@ -98,31 +156,96 @@ if __name__ == '__main__':
     if args.quiet: twitter.LoggingObject.LEVEL = twitter.LoggingObject.LEVEL_ERROR
     if args.debug: twitter.LoggingObject.LEVEL = twitter.LoggingObject.LEVEL_DEBUG
 
+    if args.command == 'schedule':
+        logging.getLogger().setLevel(logging.ERROR)
+        twitter.READ_ONLY = True
+        create_bots(args.bots)
+        schedule(args.start, args.end, args.summary)
+        raise SystemExit(0)
+
+    started = time.monotonic()
     logging.info('Robot zoo starting')
 
-    johndoeveloper = twitter.TwitterAPI('johndoeveloper')
-    casio_f91w = _casio_f91w.CasioF91W('casio_f91w')
-    deoldehove = _deoldehove.DeOldehove('deoldehove')
-    hetluchtalarm = _hetluchtalarm.Luchtalarm('hetluchtalarm')
-    y2k38warning = _y2k38warning.Y2K38Warning('y2k38warning')
-    maanfase = _maanfase.Maanfase('maanfase')
+    create_bots(args.bots)
 
-    executor = pycron.CronExecutor()
-    cron_cet = RobotZooCET('cron_cet', executor.queue)
-    cron_utc = RobotZooUTC('cron_utc', executor.queue)
+    accounts = { b.api: b for b in bots.values() }
+    runners = []
+    disabled = set()                        # bots whose account failed a check
+    disabled_lock = threading.Lock()
+
+    def disable(api, error):
+        # also called by the background recheck, which can fail before the
+        # runners exist; add_runners() applies what was recorded until then
+        if api in accounts:
+            with disabled_lock:
+                disabled.add(accounts[api])
+                for runner in runners:
+                    runner.disable(accounts[api])
+
+    def add_runners(queue):
+        with disabled_lock:
+            runners.extend(create_runners(queue))
+            for runner in runners:
+                for b in disabled:
+                    runner.disable(b)
 
-    johndoeveloper.check()
+    def recheck():
+        # checks the accounts of disabled bots again every CHECK_RETRY seconds and
+        # enables the bots whose check passes, until stopped
+        while not stopped.wait(twitter.CHECK_RETRY):
+            with disabled_lock:
+                apis = [ api for (api, b) in accounts.items() if b in disabled ]
+            if not apis:
+                continue
+            failed = twitter.check_accounts(apis, state)
+            with disabled_lock:
+                for api in apis:
+                    if api not in failed:
+                        logging.info('Check of %s passed, enabling it', api.name)
+                        disabled.discard(accounts[api])
+                        for runner in runners:
+                            runner.enable(accounts[api])
 
-    casio_f91w.api.check()
-    deoldehove.api.check()
-    hetluchtalarm.api.check()
-    y2k38warning.api.check()
-    maanfase.api.check()
+    stopped = threading.Event()
+    state = twitter.open_state('robot_zoo', logging.getLogger(__name__), default=lambda: {'checks': {}})
+    failed = twitter.check_accounts([ johndoeveloper, *accounts ], state, disable)
+    for api in failed:
+        disable(api, failed[api])
+    threading.Thread(name='Recheck', target=recheck, daemon=True).start()
+
+    if args.asyncio:
+        import asyncio
+        from . import aio
+        loop = asyncio.new_event_loop()
+        transport = aio.Transport()
+        for b in bots.values():
+            b.api = aio.BlockingAPI(aio.AsyncTwitterAPI(b.api, transport), loop)
+            if hasattr(b, 'stream'):
+                b.stream = aio.BlockingAPI(aio.AsyncTwitterAPI(b.stream, transport), loop)
+        executor = aio.AsyncExecutor()
+        add_runners(executor.queue)
+        start_timers(runners)
+        logging.info('Scheduling %.2f s after start', time.monotonic() - started)
+        try:
+            loop.run_until_complete(aio.run(runners, executor, count=4))
+        except KeyboardInterrupt:
+            print()
+            logging.info('Main thread got keyboard interrupt')
+        finally:
+            stopped.set()
+            transport.close()
+            executor.pool.shutdown(wait=False)
+            twitter.flush()
+        raise SystemExit(0)
+
+    executor = pycron.CronExecutor()
+    add_runners(executor.queue)
+    start_timers(runners)
 
-    cancel = [ cron_cet.run(),
-               cron_utc.run(),
+    cancel = [ *(runner.run() for runner in runners),
                executor.run(count=4),
              ]
+    logging.info('Scheduling %.2f s after start', time.monotonic() - started)
     try:
         while True:
             time.sleep(1)
@@ -130,5 +253,7 @@ if __name__ == '__main__':
         print()
         logging.info('Main thread got keyboard interrupt')
     finally:
+        stopped.set()
         for c in cancel:
             c()
+        twitter.flush()
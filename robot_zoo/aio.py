@@ -0,0 +1,474 @@
+import asyncio
+import collections
+import concurrent.futures
+import heapq
+import itertools
+import json
+import logging
+import math
+import ssl
+import time
+import urllib.parse
+import zlib
+
+import requests
+import requests.structures
+
+from . import oauth1
+from . import pycron
+from . import twitter
+
+ACCEPT_ENCODING = 'gzip, deflate'           # what decoder() can undo
+
+def decoder(headers):
+    # decompressor for a response's Content-Encoding (gzip or zlib deflate), None if plain
+    if headers.get('content-encoding', '').lower() in ('gzip', 'deflate'):
+        return zlib.decompressobj(32 + zlib.MAX_WBITS)
+    return None
+
+class Response(object):
+    def __init__(self, status_code, reason, headers, content):
+        self.status_code = status_code
+        self.reason = reason
+        self.headers = headers
+        self.content = content
+
+    def json(self):
+        return json.loads(self.content)
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(f"{self.status_code} {self.reason}", response=self)
+
+class Transport(object):
+    # a minimal HTTP/1.1 client with one keep-alive connection pool, shared by
+    # every account on the event loop
+    POOL_SIZE = 16                          # idle connections kept per host
+    TIMEOUT = 30
+
+    def __init__(self, ssl_context=None):
+        self.log = logging.getLogger(__name__)
+        self.ssl_context = ssl_context or ssl.create_default_context()
+        self.idle = {}                      # (scheme, host, port) -> [(reader, writer)]
+
+    async def connect(self, key):
+        idle = self.idle.get(key)
+        while idle:
+            (reader, writer) = idle.pop()
+            if not writer.is_closing() and not reader.at_eof():
+                return (reader, writer, True)
+            writer.close()
+        (scheme, host, port) = key
+        (reader, writer) = await asyncio.open_connection(host, port, ssl=(self.ssl_context if scheme == 'https' else None))
+        return (reader, writer, False)
+
+    def release(self, key, reader, writer):
+        idle = self.idle.setdefault(key, [])
+        if len(idle) < self.POOL_SIZE:
+            idle.append((reader, writer))
+        else:
+            writer.close()
+
+    def close(self):
+        for idle in self.idle.values():
+            for (_, writer) in idle:
+                writer.close()
+        self.idle.clear()
+
+    async def send(self, request):
+        return await asyncio.wait_for(self._send(request), self.TIMEOUT)
+
+    def encode(self, request):
+        url = urllib.parse.urlsplit(request.url)
+        key = (url.scheme, url.hostname, url.port or (443 if url.scheme == 'https' else 80))
+        body = request.body or b''
+        body = body.encode('utf8') if isinstance(body, str) else body
+        head = [ f"{request.method} {request.path_url} HTTP/1.1", f"Host: {url.netloc}", f"Content-Length: {len(body)}" ]
+        head += [ f"{k}: {v}" for (k, v) in request.headers.items() if k.lower() not in ('host', 'content-length', 'accept-encoding') ]
+        head.append(f"Accept-Encoding: {ACCEPT_ENCODING}")
+        return (key, ('\r\n'.join(head) + '\r\n\r\n').encode('latin-1') + body)
+
+    async def _send(self, request):
+        (key, data) = self.encode(request)
+        while True:
+            (reader, writer, reused) = await self.connect(key)
+            try:
+                writer.write(data)
+                await writer.drain()
+                (response, keep_alive) = await self.read_response(reader)
+            except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+                writer.close()
+                if reused:                  # the server closed an idle connection; try a fresh one
+                    continue
+                raise
+            except BaseException:
+                writer.close()
+                raise
+            if keep_alive:
+                self.release(key, reader, writer)
+            else:
+                writer.close()
+            return response
+
+    async def stream(self, request):
+        # sends request on a connection of its own (never pooled) and returns
+        # the response once its headers are in, with a StreamBody as content
+        (key, data) = self.encode(request)
+        (scheme, host, port) = key
+        (reader, writer) = await asyncio.wait_for(asyncio.open_connection(host, port, ssl=(self.ssl_context if scheme == 'https' else None)), self.TIMEOUT)
+        try:
+            writer.write(data)
+            await writer.drain()
+            (version, code, reason, headers) = await asyncio.wait_for(self.read_head(reader), self.TIMEOUT)
+        except BaseException:
+            writer.close()
+            raise
+        return Response(code, reason, headers, StreamBody(reader, writer, headers.get('transfer-encoding', '').lower() == 'chunked', decoder(headers)))
+
+    async def read_head(self, reader):
+        (version, code, *reason) = (await reader.readline()).decode('latin-1').rstrip('\r\n').split(' ', 2)
+        headers = requests.structures.CaseInsensitiveDict()
+        while (line := (await reader.readline()).decode('latin-1').rstrip('\r\n')):
+            (k, _, v) = line.partition(':')
+            headers[k.strip()] = v.strip()
+        return (version, int(code), ''.join(reason), headers)
+
+    async def read_response(self, reader):
+        (version, code, reason, headers) = await self.read_head(reader)
+        keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            content = bytearray()
+            while (size := int((await reader.readline()).split(b';')[0], 16)):
+                content += await reader.readexactly(size)
+                await reader.readline()
+            while (await reader.readline()) not in (b'\r\n', b''):
+                pass
+        elif 'content-length' in headers:
+            content = await reader.readexactly(int(headers['content-length']))
+        else:
+            content = await reader.read()
+            keep_alive = False
+        if (d := decoder(headers)):
+            content = d.decompress(content) + d.flush()
+        return (Response(code, reason, headers, bytes(content)), keep_alive)
+
+class StreamBody(object):
+    # the body of a streamed response, read as it arrives: read1() returns what
+    # is there (transfer and content encoding undone), b'' at the end
+    TIMEOUT = 90                            # streams send keep-alives every 30 s; longer means stalled
+
+    def __init__(self, reader, writer, chunked, decoder=None):
+        self.reader = reader
+        self.writer = writer
+        self.chunked = chunked
+        self.decoder = decoder
+        self.left = 0                       # bytes left of the current chunk
+        self.done = False
+
+    async def read1(self, size):
+        return await asyncio.wait_for(self._read1(size), self.TIMEOUT)
+
+    async def _read1(self, size):
+        while True:
+            data = await self.read_raw(size)
+            if self.decoder is None:
+                return data
+            if not data:
+                (data, self.decoder) = (self.decoder.flush(), None)
+                return data
+            if (data := self.decoder.decompress(data)):
+                return data
+
+    async def read_raw(self, size):
+        if self.done:
+            return b''
+        if self.chunked and not self.left:
+            self.left = int((await self.reader.readline()).split(b';')[0] or b'0', 16)
+            if not self.left:
+                self.close()
+                return b''
+        data = await self.reader.read(min(size, self.left) if self.chunked else size)
+        if not data:
+            self.close()
+            return b''
+        if self.chunked:
+            self.left -= len(data)
+            if not self.left:
+                await self.reader.readline()
+        return data
+
+    def close(self):
+        self.done = True
+        self.writer.close()
+
+class AsyncTwitterAPI(object):
+    # coroutine version of a TwitterAPI; endpoints, configuration and rate limits
+    # are those of the wrapped api
+    def __init__(self, api, transport):
+        self.api = api
+        self.name = api.name
+        self.log = api.log
+        self.transport = transport
+        self.signer = None
+        api.config.on_reload(self.config_reloaded)
+
+    def config_reloaded(self, old, new):
+        if (old or {}).get('oauth') != new.get('oauth'):
+            self.signer = None
+
+    def __getattr__(self, name):
+        endpoint = self.api.endpoint(name)
+        async def caller(*args, **kwargs):
+            return await self.call(endpoint, *args, **kwargs)
+        caller.name = name
+        caller.endpoint = endpoint
+        self.__dict__[name] = caller
+        return caller
+
+    async def call(self, endpoint, *args, **kwargs):
+        while (wait := self.api.reserve(endpoint)) > 0:
+            await asyncio.sleep(wait)
+        return await self.send(endpoint, args, kwargs)
+
+    async def send(self, endpoint, args, kwargs):
+        # call() once the rate limits allow it
+        kwargs = { k: str(v).encode('utf8') for (k, v) in kwargs.items() }
+        if not self.signer:
+            self.signer = oauth1.Oauth1(config=self.api.config['oauth'])
+        content = None
+        try:
+            (get, post) = ({}, kwargs) if endpoint.method == 'POST' else (kwargs, {})
+            request = self.signer._create_request(endpoint.method, endpoint.url(args), get, post, {'Accept': 'application/json'})
+            self.log.debug('--> %s: %s', endpoint.name, request.url)
+            response = await (self.transport.stream if endpoint.stream else self.transport.send)(request)
+            self.log.debug('<-- %s: %s', endpoint.name, response.status_code)
+            self.api.rate_limiter.update((self.api.name, endpoint.bucket), response.headers)
+            if endpoint.stream:
+                content = self.messages(response.content, kwargs.get('delimited') == b'length')
+                if response.status_code >= 400:
+                    response.content.close()
+            else:
+                content = response.json()
+            response.raise_for_status()
+            return content
+        except Exception as e:
+            raise twitter.FailWhale(content, e)
+
+    async def messages(self, body, delimited):
+        # async version of the messages TwitterAPI.call returns for a stream
+        splitter = twitter.MessageSplitter(delimited)
+        try:
+            while (chunk := await body.read1(self.api.STREAM_BUFFER)):
+                for message in splitter.feed(chunk):
+                    yield self.api.try_json_decode(message)
+            for message in splitter.end():
+                yield self.api.try_json_decode(message)
+        finally:
+            body.close()
+
+class BlockingAPI(object):
+    # adapter for unchanged bot code running in executor threads: API calls are
+    # run on the event loop and waited for; everything else goes to the wrapped api
+    def __init__(self, api, loop):
+        self.api = api
+        self.loop = loop
+
+    def __getattr__(self, name):
+        try:
+            endpoint = self.api.api.endpoint(name)
+        except AttributeError:
+            return getattr(self.api.api, name)
+        def caller(*args, **kwargs):
+            # rate limits are waited for here: in an executor worker that raises
+            # RateLimited, so the task is rescheduled instead of holding the thread
+            self.api.api.throttle(endpoint)
+            result = asyncio.run_coroutine_threadsafe(self.api.send(endpoint, args, kwargs), self.loop).result()
+            return self.iterate(result) if endpoint.stream else result
+        caller.name = name
+        caller.endpoint = endpoint
+        return caller
+
+    def iterate(self, messages):
+        # the messages of an async stream for a thread, each fetched on the loop
+        async def step():
+            return await messages.__anext__()
+        try:
+            while True:
+                try:
+                    yield asyncio.run_coroutine_threadsafe(step(), self.loop).result()
+                except StopAsyncIteration:
+                    return
+        finally:
+            asyncio.run_coroutine_threadsafe(messages.aclose(), self.loop).result()
+
+class AsyncTaskQueue(object):
+    # pycron.KeyedTaskQueue for the event loop: lowest (priority, deadline) first,
+    # one task per bot at a time, stale tasks dropped, delays through loop timers
+    def __init__(self):
+        self.log = logging.getLogger(__name__)
+        self.ready = {}                     # owner -> heap of (priority, deadline, seq, task)
+        self.busy = set()
+        self.stops = 0
+        self.seq = itertools.count()
+        self.waiting = collections.deque()
+        self.delayed = 0
+        self.dropped = {}
+
+    def put(self, task, delay=0):
+        if delay > 0:
+            if task.deadline is not None and task.deadline < time.monotonic() + delay:
+                self.drop(task, time.monotonic() + delay)
+                return
+            self.delayed += 1
+            asyncio.get_running_loop().call_later(delay, self.put_delayed, task)
+            return
+        if task is None:
+            self.stops += 1
+        else:
+            key = (task.priority, math.inf if task.deadline is None else task.deadline)
+            heapq.heappush(self.ready.setdefault(pycron.serial_key(task.action), []), (*key, next(self.seq), task))
+        self.notify()
+
+    def put_delayed(self, task):
+        self.delayed -= 1
+        self.put(task)
+
+    def notify(self):
+        while self.waiting:
+            waiter = self.waiting.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                break
+
+    def drop(self, task, now):
+        self.log.info('Dropping %r, %.3f s past its deadline', task, now - task.deadline)
+        self.dropped[task.name] = self.dropped.get(task.name, 0) + 1
+
+    async def get(self):
+        while True:
+            now = time.monotonic()
+            best = None                     # (entry, owner)
+            for (key, heap) in self.ready.items():
+                if key is not None and key in self.busy:
+                    continue
+                while heap and heap[0][1] < now:
+                    self.drop(heapq.heappop(heap)[3], now)
+                if heap and (best is None or heap[0] < best[0]):
+                    best = (heap[0], key)
+            if best:
+                key = best[1]
+                task = heapq.heappop(self.ready[key])[3]
+                if not self.ready[key]:
+                    del self.ready[key]
+                if key is not None:
+                    self.busy.add(key)
+                return task
+            if self.stops:
+                self.stops -= 1
+                return None
+            waiter = asyncio.get_running_loop().create_future()
+            self.waiting.append(waiter)
+            await waiter
+
+    def done(self, task):
+        key = pycron.serial_key(task.action)
+        if key is not None:
+            self.busy.discard(key)
+            self.notify()
+
+    def qsize(self):
+        return sum(len(heap) for heap in self.ready.values()) + self.delayed + self.stops
+
+class AsyncExecutor(object):
+    # coroutine actions run on the loop; plain bot methods run unchanged in a
+    # small thread pool. Retries are loop timers, never sleeping threads.
+    RETRY_BASE = 1
+    RETRY_JITTER = 0.5
+
+    def __init__(self, threads=4):
+        self.name = 'executor'
+        self.log = logging.getLogger(__name__)
+        self.queue = AsyncTaskQueue()
+        self.pool = concurrent.futures.ThreadPoolExecutor(threads, thread_name_prefix='Executor')
+        self.retried = 0
+        self.failed = 0
+
+    backoff = pycron.CronExecutor.backoff
+
+    def run_sync(self, task):
+        twitter.worker.attempt = task.attempt
+        try:
+            return task()
+        finally:
+            twitter.worker.attempt = None
+
+    async def run_task(self, task):
+        if asyncio.iscoroutinefunction(task.action):
+            try:
+                return await task()
+            except twitter.FailWhale as e:
+                self.log.error("Retry caught %s - %r", type(e).__name__, e)
+                if task.attempt >= twitter.RETRIES:
+                    return None
+                raise twitter.Retry(e, task.attempt)
+        return await asyncio.get_running_loop().run_in_executor(self.pool, self.run_sync, task)
+
+    async def worker(self):
+        while (task := await self.queue.get()) is not None:
+            try:
+                await self.run_task(task)
+            except twitter.Retry as r:
+                delay = max(r.wait, self.backoff(r.attempt))
+                self.log.info('Retrying %s in %.1f s', task.name, delay)
+                self.retried += 1
+                task.attempt = r.attempt + 1
+                self.queue.put(task, delay=delay)
+            except Exception as e:
+                self.failed += 1
+                self.log.exception('Executor caught %s; skipping task', type(e).__name__)
+            finally:
+                self.queue.done(task)
+
+    async def run(self, count=4):
+        await asyncio.gather(*(self.worker() for _ in range(count)))
+
+class AsyncCronRunner(object):
+    # drives a pycron.CronRunner from the event loop instead of its own thread
+    def __init__(self, runner):
+        self.runner = runner
+
+    async def sleep(self, seconds, woken):
+        try:
+            await asyncio.wait_for(woken.wait(), seconds)
+        except asyncio.TimeoutError:
+            pass
+
+    async def run(self):
+        runner = self.runner
+        woken = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        runner.wake = lambda: loop.call_soon_threadsafe(woken.set)
+        now = start = int(time.time())
+        while True:
+            woken.clear()
+            if (due := runner.next_fire(now)) is None:
+                runner.log.info('%s: no more rules can fire', runner.name)
+                await woken.wait()
+                now = int(time.time())
+                continue
+            while (remaining := due - time.time()) > 0 and not woken.is_set():
+                await self.sleep(min(remaining, runner.MAX_SLEEP), woken)
+            if woken.is_set() and time.time() < due:
+                now = int(time.time())
+                continue
+            late = time.time() - due
+            if late < 0 or late >= 1:
+                if late >= 1:
+                    runner.log.warning('%s: missed %s by %.1f s, skipping', runner.name, time.strftime('%H:%M:%S', runner.get_time(due)), late)
+                now = int(time.time())
+                continue
+            runner.fire(due, late, record=due > start)
+            now = due + 1
+
+async def run(runners, executor, count=4):
+    await asyncio.gather(executor.run(count), *(AsyncCronRunner(runner).run() for runner in runners))
@@ -0,0 +1,15 @@
+import importlib
+
+# bot name -> (module, class); a bot's module, and with it its dependencies, is
+# only imported when the bot is created
+REGISTRY = {
+    'casio_f91w':    ('casio_f91w',    'CasioF91W'),
+    'deoldehove':    ('deoldehove',    'DeOldehove'),
+    'hetluchtalarm': ('hetluchtalarm', 'Luchtalarm'),
+    'y2k38warning':  ('y2k38warning',  'Y2K38Warning'),
+    'maanfase':      ('maanfase',      'Maanfase'),
+}
+
+def create(name, *args, **kwargs):
+    (module, cls) = REGISTRY[name]
+    return getattr(importlib.import_module('.' + module, __name__), cls)(name, *args, **kwargs)
@@ -1,8 +1,12 @@
+import concurrent.futures
+import functools
 import os
 import time
 import re
+import sys
 import datetime
 import logging
+import threading
 
 import pytz
 
@@ -11,23 +15,176 @@ from .. import twitter
 CET = pytz.timezone('Europe/Amsterdam')
 UTC = pytz.utc
 
+@functools.lru_cache(maxsize=4096)
+def to_cet(today, hour, minute, offset):
+    # (hour, minute) in CET of hour:minute today at UTC offset (in minutes)
+    base = datetime.datetime.combine(today, datetime.time(hour=hour, minute=minute)).replace(tzinfo=UTC)
+    d = (base - datetime.timedelta(minutes=offset)).astimezone(CET)
+    return (d.hour, d.minute)
+
+class AlarmStore:
+    # alarms by minute of day, so the alarms due at a minute are one list lookup,
+    # and by the day they were set, so expiring them is dropping whole dicts.
+    # Changes are appended to a journal file on save(); the journal is rewritten
+    # (compacted) once most of its lines are obsolete. Alarms that didn't go off
+    # within TTL days (the bot was down at that minute) are dropped.
+    TTL = 2
+    COMPACT_MIN = 1000                      # obsolete journal lines before compacting
+
+    def __init__(self, path, log=None):
+        self.path = path
+        self.log = log if log else logging.getLogger(__name__)
+        self.lock = threading.RLock()
+        self.slots = [ {} for _ in range(1440) ]     # minute -> {day set: {tweet id: screen name}}
+        self.count = 0
+        self.pending = []                   # journal lines not written yet
+        self.logged = 0                     # journal lines on disk
+        self.load()
+
+    def __len__(self):
+        return self.count
+
+    def items(self):
+        # [(minute of day, tweet id, screen name, day set)]
+        with self.lock:
+            return [ (minute, tid, screen_name, day)
+                     for (minute, slot) in enumerate(self.slots)
+                     for (day, alarms) in slot.items()
+                     for (tid, screen_name) in alarms.items() ]
+
+    def load(self):
+        # a torn last line (a crash while appending) is cut off, so the next
+        # save() appends to a complete line; lines that don't parse are skipped
+        if not self.path or not os.path.exists(self.path):
+            return
+        self.log.info('Loading %s', self.path)
+        size = 0                            # bytes up to the end of the last complete line
+        with open(self.path, 'rb') as f:
+            for line in f:
+                if not line.endswith(b'\n'):
+                    self.log.warning('Dropping incomplete last line of %s', self.path)
+                    break
+                size += len(line)
+                self.logged += 1
+                try:
+                    op, minute, tid, *rest = line.decode('utf8').split()
+                    if op == '+':
+                        self.insert(int(minute), int(tid), rest[0], int(rest[1]))
+                    elif op == '-':
+                        self.delete(int(minute), int(tid))
+                    else:
+                        raise ValueError(f"unknown operation {op!r}")
+                except (ValueError, IndexError) as e:
+                    self.log.warning('Skipping bad line of %s: %r (%s)', self.path, line, e)
+        if size < os.path.getsize(self.path):
+            os.truncate(self.path, size)
+
+    def insert(self, minute, tid, screen_name, day):
+        self.delete(minute, tid)
+        self.slots[minute].setdefault(day, {})[tid] = sys.intern(screen_name)
+        self.count += 1
+
+    def delete(self, minute, tid):
+        slot = self.slots[minute]
+        for (day, alarms) in slot.items():
+            if alarms.pop(tid, None):
+                self.count -= 1
+                if not alarms:
+                    del slot[day]
+                return
+
+    def today(self, now):
+        return int((now if now is not None else time.time()) // 86400)
+
+    def add(self, hour, minute, tid, screen_name, now=None):
+        day = self.today(now)
+        with self.lock:
+            self.insert(hour * 60 + minute, int(tid), screen_name, day)
+            self.pending.append(f"+ {hour * 60 + minute} {tid} {screen_name} {day}\n")
+
+    def remove(self, hour, minute, tids):
+        with self.lock:
+            for tid in tids:
+                self.delete(hour * 60 + minute, int(tid))
+                self.pending.append(f"- {hour * 60 + minute} {tid}\n")
+
+    def due(self, hour, minute, now=None):
+        # [(tweet id, screen name)] of the alarms set for hour:minute; expired
+        # ones are removed instead
+        with self.lock:
+            self.expire_slot(hour * 60 + minute, self.today(now) - self.TTL)
+            return [ alarm for alarms in self.slots[hour * 60 + minute].values() for alarm in alarms.items() ]
+
+    def expire_slot(self, minute, limit):
+        slot = self.slots[minute]
+        for day in [ day for day in slot if day < limit ]:
+            self.log.info('Dropping %d expired alarms for %02d:%02d', len(slot[day]), *divmod(minute, 60))
+            self.count -= len(slot[day])
+            self.pending.extend(f"- {minute} {tid}\n" for tid in slot.pop(day))
+
+    def expire(self, now=None):
+        with self.lock:
+            for minute in range(1440):
+                self.expire_slot(minute, self.today(now) - self.TTL)
+
+    def save(self):
+        if not self.path:
+            self.pending = []
+            return
+        with self.lock:
+            if self.logged + len(self.pending) - self.count > max(self.count, self.COMPACT_MIN):
+                self.compact()
+            elif self.pending:
+                with open(self.path, 'a', encoding='utf8') as f:
+                    f.writelines(self.pending)
+                self.logged += len(self.pending)
+            self.pending = []
+
+    def compact(self):
+        self.log.info('Compacting %s', self.path)
+        self.expire()
+        lines = [ f"+ {minute} {tid} {screen_name} {day}\n" for (minute, tid, screen_name, day) in self.items() ]
+        twitter.write_atomic(self.path, ''.join(lines).encode('utf8'))
+        self.logged = len(lines)
+
 class CasioF91W:
     DAYS = ['MO', 'TU', 'WE', 'TH', 'FR', 'SA', 'SU']
     # TODO: change to f-string
     MSG = 'BEEP BEEP! {0} {1} {2:02}:{3:02}:00'
 
-    R1 = re.compile(r'alarm ([01]?[0-9]|2[0-3]):([0-5][0-9]) ([+-])([01][0-9]|2[0-3])([0-5][0-9])')
-    R2 = re.compile(r'alarm (0?[1-9]|1[0-2]):([0-5][0-9]) (AM|PM) ([+-])([01][0-9]|2[0-3])([0-5][0-9])')
-    R3 = re.compile(r'alarm (0?[1-9]|1[0-2]):([0-5][0-9]) (AM|PM)')
-    R4 = re.compile(r'alarm ([01]?[0-9]|2[0-3]):([0-5][0-9])')
+    FANOUT = 4                              # replies in flight, one per pooled connection
+    MENTIONS_PAGE = 200
+
+    # every alarm form in one pattern: hh:mm <AM|PM> or hh:mm, then an optional
+    # <+|->hhmm. Forms are ranked like the separate patterns they replace:
+    # hh:mm <+|->hhmm, hh:mm <AM|PM> <+|->hhmm, hh:mm <AM|PM>, hh:mm
+    ALARM = re.compile(r'alarm (?:(0?[1-9]|1[0-2]):([0-5][0-9]) (AM|PM)|([01]?[0-9]|2[0-3]):([0-5][0-9]))'
+                       r'(?: ([+-])([01][0-9]|2[0-3])([0-5][0-9]))?')
 
-    def __init__(self, name, api=None, config=None):
+    def __init__(self, name, api=None, config=None, alarms=None):
         self.name = name
         self.log = logging.getLogger(__name__)
         self.api = api if api else twitter.TwitterAPI(name, self.log)
-        self.state = config if config else twitter.Configuration(config_file=f"{os.environ.get('ROBOT_ZOO_STATE_DIR', '.')}/{self.name}.state.json",
-                                                                 log=self.log,
-                                                                 default=lambda: {'alarms': {}, 'last_mention': None})
+        self.state = config if config else twitter.open_state(self.name, self.log, default=lambda: {'last_mention': None, 'mention_cursor': None})
+        self.alarms = alarms if alarms is not None else AlarmStore(f"{os.environ.get('ROBOT_ZOO_STATE_DIR', '.')}/{self.name}.alarms", self.log)
+        self.migrate_alarms()
+
+    def migrate_alarms(self):
+        # alarms used to be kept in the state file as {"HH:MM": {id: screen name}}
+        try:
+            legacy = self.state['alarms']
+        except KeyError:
+            return
+        if not legacy:
+            return
+        self.log.info('Moving %d alarm times from state to %s', len(legacy), self.alarms.path)
+        for (key, alarms) in legacy.items():
+            (hour, minute) = map(int, key.split(':'))
+            for (tid, screen_name) in alarms.items():
+                self.alarms.add(hour, minute, tid, screen_name)
+        self.state['alarms'] = {}
+        self.alarms.save()
+        self.state.save()
 
     @twitter.retry
     def send_beep(self, t):
@@ -37,93 +194,113 @@ class CasioF91W:
         return True
 
     def save_alarm(self, alarm, mention):
-        key = '{0:02}:{1:02}'.format(*alarm)
-        m_id, m_sn = mention['id'], mention['user']['screen_name']
-        if key not in self.state['alarms']:
-            self.state['alarms'][key] = {}
-        self.state['alarms'][key][m_id] = m_sn
+        self.alarms.add(*alarm, mention['id'], mention['user']['screen_name'])
 
-    def parse_tweet_for_alarm(self, tweet):
+    def parse_tweet_for_alarm(self, tweet, today=None):
         id, screen_name, text = tweet['id'], tweet['user']['screen_name'], tweet['text']
 
-        match = self.R1.search(text) # hh:mm <+|->hhmm
-        if match:
-            self.log.info('Alarm: #%d from @%s: %s --> %r', id, screen_name, repr(text), match.groups())
-            th, tm, sign, zh, zm = match.groups()
-            th, tm = int(th), int(tm)
-            zh, zm = int(zh), int(zm)
-            sign = +1 if sign == '+' else -1
-            base = datetime.datetime.combine(datetime.date.today(), datetime.time(hour=th, minute=tm)).replace(tzinfo=UTC)
-            offset = sign * datetime.timedelta(hours=zh, minutes=zm)
-            d = (base - offset).astimezone(CET)
-            return ((d.hour, d.minute), tweet)
-
-        match = self.R2.search(text) # hh:mm <AM|PM> <+|->hhmm
-        if match:
-            self.log.info('Alarm: #%d from @%s: %s --> %r', id, screen_name, repr(text), match.groups())
-            th, tm, am_pm, sign, zh, zm = match.groups()
-            th, tm = int(th), int(tm)
-            zh, zm = int(zh), int(zm)
-            sign = +1 if sign == '+' else -1
-            if am_pm == 'AM' and th == 12: th -= 12
-            if am_pm == 'PM' and th  < 12: th += 12
-            base = datetime.datetime.combine(datetime.date.today(), datetime.time(hour=th, minute=tm)).replace(tzinfo=UTC)
-            offset = sign * datetime.timedelta(hours=zh, minutes=zm)
-            d = (base - offset).astimezone(CET)
-            return ((d.hour, d.minute), tweet)
-
-        match = self.R3.search(text) # hh:mm <AM|PM>
-        if match:
-            self.log.info('Alarm: #%d from @%s: %s --> %r', id, screen_name, repr(text), match.groups())
-            th, tm, am_pm = match.groups()
-            th, tm = int(th), int(tm)
+        best = None
+        for match in self.ALARM.finditer(text):
+            h12, m12, am_pm, h24, m24, sign, zh, zm = match.groups()
+            rank = (2 if sign else 3) if am_pm else (1 if sign else 4)
+            if not best or rank < best[0]:
+                best = (rank, match)
+        if not best:
+            return (None, tweet)
+
+        match = best[1]
+        h12, m12, am_pm, h24, m24, sign, zh, zm = match.groups()
+        groups = tuple(g for g in match.groups() if g is not None)
+        self.log.info('Alarm: #%s from @%s: %s --> %r', id, screen_name, repr(text), groups)
+        if am_pm:
+            th, tm = int(h12), int(m12)
             if am_pm == 'AM' and th == 12: th -= 12
             if am_pm == 'PM' and th  < 12: th += 12
-            return ((th, tm), tweet)
+        else:
+            th, tm = int(h24), int(m24)
+        if sign:
+            offset = (+1 if sign == '+' else -1) * (int(zh) * 60 + int(zm))
+            return (to_cet(today or datetime.date.today(), th, tm, offset), tweet)
+        return ((th, tm), tweet)
 
-        match = self.R4.search(text) # hh:mm
-        if match:
-            self.log.info('Alarm: #%d from @%s: %s --> %r', id, screen_name, repr(text), match.groups())
-            th, tm = match.groups()
-            th, tm = int(th), int(tm)
-            return ((th, tm), tweet)
+    def parse_mentions(self, mentions):
+        today = datetime.date.today()
+        return [ self.parse_tweet_for_alarm(m, today) for m in mentions ]
 
-        return (None, tweet)
+    def get_mention_pages(self):
+        # pages of mentions newer than last_mention, newest first, walking down
+        # with max_id. The cursor is saved after each page the caller is done
+        # with, so after a crash the walk resumes where it stopped; last_mention
+        # moves up once the walk reaches it.
+        while True:
+            since = self.state['last_mention']
+            (max_id, top) = self.get_state('mention_cursor') or (None, None)
+            kwargs = {'count': self.MENTIONS_PAGE}
+            if since:
+                kwargs['since_id'] = since
+            if max_id:
+                kwargs['max_id'] = max_id
+            page = self.api.get_statuses_mentions_timeline(**kwargs)
+            if page:
+                ids = [ int(m['id']) for m in page ]
+                top = top or str(max(ids))
+                yield page
+                self.state['mention_cursor'] = [ str(min(ids) - 1), top ]
+                self.checkpoint()
+                if since:
+                    continue
+            if not top:
+                return
+            self.state['last_mention'] = top
+            self.state['mention_cursor'] = None
+            self.checkpoint()
+            return
 
     def get_mentions(self):
-        last_mention = self.state['last_mention']
-        if last_mention:
-            mentions = self.api.get_statuses_mentions_timeline(count=200, since_id=last_mention)
-        else:
-            mentions = self.api.get_statuses_mentions_timeline(count=200)
-        if mentions:
-            self.state['last_mention'] = str(max(int(m['id']) for m in mentions))
-        return mentions
+        for page in self.get_mention_pages():
+            yield from page
+
+    def get_state(self, name):
+        try:
+            return self.state[name]
+        except KeyError:
+            return None
+
+    def checkpoint(self):
+        self.alarms.save()
+        self.state.save()
 
     @twitter.retry
     def handle_mentions(self, t):
-        dirty = False
-        for m in self.get_mentions():
-            alarm, mention = self.parse_tweet_for_alarm(m)
-            if alarm:
-                self.save_alarm(alarm, mention)
-                dirty = True
-        if dirty:
-            self.api.save()
+        for page in self.get_mention_pages():
+            for (alarm, mention) in self.parse_mentions(page):
+                if alarm:
+                    self.save_alarm(alarm, mention)
         return True
 
+    def send_alarm(self, tid, screen_name):
+        status = '@{0}'.format(screen_name)
+        while len(status) < 130:
+            status += ' BEEP BEEP!'
+        self.log.info('Posting status: %s (%r)', repr(status), len(status))
+        try:
+            self.api.post_statuses_update(status=status, in_reply_to_status_id=tid)
+        except twitter.FailWhale as e:
+            return e
+
     @twitter.retry
     def send_alarms(self, t):
-        key = '{0:02}:{1:02}'.format(t.tm_hour, t.tm_min)
-        if key in self.state['alarms']:
-            for (tid, screen_name) in [*self.state['alarms'][key].items()]:
-                status = '@{0}'.format(screen_name)
-                while len(status) < 130:
-                    status += ' BEEP BEEP!'
-                self.log.info('Posting status: %s (%r)', repr(status), len(status))
-                self.api.post_statuses_update(status=status, in_reply_to_status_id=tid)
-                del self.state['alarms'][key][tid]
-                if not self.state['alarms'][key]:
-                    del self.state['alarms'][key]
-            self.api.save()
+        # replies go out concurrently; only the ones that were sent are removed,
+        # so a retry re-sends just the failed ones
+        alarms = self.alarms.due(t.tm_hour, t.tm_min)
+        if not alarms:
+            return True
+        with concurrent.futures.ThreadPoolExecutor(min(self.FANOUT, len(alarms))) as pool:
+            errors = list(pool.map(lambda alarm: self.send_alarm(*alarm), alarms))
+        self.alarms.remove(t.tm_hour, t.tm_min, [ tid for ((tid, _), error) in zip(alarms, errors) if not error ])
+        self.alarms.save()
+        failed = [ error for error in errors if error ]
+        if failed:
+            self.log.error('%d of %d alarms for %02d:%02d failed', len(failed), len(alarms), t.tm_hour, t.tm_min)
+            raise failed[0]
         return True
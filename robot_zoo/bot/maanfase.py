@@ -1,6 +1,11 @@
 
 from datetime import datetime
 import logging
+import mmap
+import os
+import struct
+import threading
+import time
 
 import ephem
 import pytz
@@ -20,8 +25,53 @@ PHASE_FUNC = [ephem.next_new_moon,
               ephem.next_full_moon,
               ephem.next_last_quarter_moon]
 
+class PhaseCache(object):
+    # phases per year in a fixed-width file: year y is a block of SLOTS records
+    # (month, day, hour, minute, second, phase) at (y - FIRST_YEAR) * BLOCK, all
+    # zeroes until computed; read through a memory map
+    FIRST_YEAR = 1900
+    SLOTS = 52
+    RECORD = struct.Struct('6B')
+    BLOCK = SLOTS * RECORD.size
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.map = None
+
+    def offset(self, year):
+        return (year - self.FIRST_YEAR) * self.BLOCK
+
+    def get(self, year):
+        if year < self.FIRST_YEAR:
+            return None
+        end = self.offset(year) + self.BLOCK
+        with self.lock:
+            if (self.map is None or len(self.map) < end) and os.path.exists(self.path) and os.path.getsize(self.path) >= end:
+                if self.map is not None:
+                    self.map.close()
+                with open(self.path, 'rb') as f:
+                    self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            if self.map is None or len(self.map) < end:
+                return None
+            block = self.map[end - self.BLOCK:end]
+        return [ record for record in self.RECORD.iter_unpack(block) if record[0] ] or None
+
+    def put(self, year, records):
+        if year < self.FIRST_YEAR or twitter.READ_ONLY:
+            return
+        block = b''.join(self.RECORD.pack(*record) for record in records[:self.SLOTS]).ljust(self.BLOCK, b'\0')
+        with self.lock:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                os.pwrite(fd, block, self.offset(year))
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
 class MoonModel(object):
-    def __init__(self, year=None):
+    def __init__(self, year=None, cache=None):
+        self.cache = cache
         self.year = year
 
     @property
@@ -31,24 +81,33 @@ class MoonModel(object):
     @year.setter
     def year(self, year):
         self._year = year
-        if year:
-            dt = datetime(year, 1, 1, 0, 0, 0, tzinfo=TZ_CET).astimezone(TZ_UTC)
-            time = ephem.Date(dt)
-            phase = self._first_phase(time)
-            self._phases = { (d.year, d.month, d.day, d.hour, d.minute): (d.hour, d.minute, d.second, phase)
-                             for (phase, d) in self._calc_phases(time, phase) }
-        else:
-            self._phases = {}
+        self._phases = { (year, mo, d, h, mi): (h, mi, s, phase) for (mo, d, h, mi, s, phase) in self.phases(year) } if year else {}
+
+    def phases(self, year):
+        # [(month, day, hour, minute, second, phase)] of a year, from the cache if
+        # it has the year; computed (and cached) otherwise
+        records = self.cache.get(year) if self.cache else None
+        if records is None:
+            records = self._compute(year)
+            if self.cache:
+                self.cache.put(year, records)
+        return records
+
+    def _compute(self, year):
+        dt = datetime(year, 1, 1, 0, 0, 0, tzinfo=TZ_CET).astimezone(TZ_UTC)
+        time = ephem.Date(dt)
+        phase = self._first_phase(time)
+        return [ (d.month, d.day, d.hour, d.minute, d.second, phase) for (phase, d) in self._calc_phases(year, time, phase) ]
 
     def _first_phase(self, year):
         times = [ (i, f(year)) for (i, f) in enumerate(PHASE_FUNC) ]
         first = min(times, key=lambda t: t[1])
         return first[0]
 
-    def _calc_phases(self, time, phase):
+    def _calc_phases(self, year, time, phase):
         while True:
             time = PHASE_FUNC[phase](time)
-            if time.datetime().replace(tzinfo=TZ_UTC).astimezone(TZ_CET).year != self.year:
+            if time.datetime().replace(tzinfo=TZ_UTC).astimezone(TZ_CET).year != year:
                 break
             yield (phase, time.datetime().replace(tzinfo=TZ_UTC).astimezone(TZ_CET))
             phase = (phase + 1) % 4
@@ -57,11 +116,35 @@ class MoonModel(object):
         return self._phases.get(key, None)
 
 class Maanfase(object):
-    def __init__(self, name, api=None):
+    YEARS_AHEAD = 1                         # years after the current one warm_up() makes sure are cached
+    HOUSEKEEPING = ('schedule', 'warm_up')  # actions that don't post: left out of the schedule dry run, timers never dropped
+
+    def __init__(self, name, api=None, cache=None):
         self.name = name
         self.log = logging.getLogger(__name__)
         self.api = api if api else twitter.TwitterAPI(name, self.log)
-        self.moon = MoonModel()
+        self.moon = MoonModel(cache=cache or PhaseCache(f"{os.environ.get('ROBOT_ZOO_STATE_DIR', '.')}/{name}.phases"))
+
+    def add_timers(self, year, runner, since=0):
+        # a timer on runner for every phase of year at or after since (epoch seconds)
+        for (mo, d, h, mi, s, phase) in self.moon.phases(year):
+            when = TZ_CET.localize(datetime(year, mo, d, h, mi, s)).timestamp()
+            if when >= since:
+                runner.at(when, self.post_phase)
+
+    def schedule(self, t, runner):
+        # the timers of the phases left in t's year, and one at new year to
+        # schedule the next; replaces posting from a rule that fires every minute
+        self.add_timers(t.tm_year, runner, time.time())
+        runner.at(TZ_CET.localize(datetime(t.tm_year + 1, 1, 1)).timestamp(), self.schedule, runner)
+
+    def warm_up(self, t):
+        # computes the phases of the coming years ahead of time, so that no year is
+        # ever computed at its first post
+        for year in range(t.tm_year, t.tm_year + self.YEARS_AHEAD + 1):
+            if self.moon.cache.get(year) is None:
+                self.log.info("Computing phases for %d", year)
+                self.moon.phases(year)
 
     @twitter.retry
     def post_phase(self, t):
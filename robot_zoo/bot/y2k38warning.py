@@ -5,6 +5,8 @@ from .. import twitter
 # 2038-01-19 03:14:07 UTC
 
 class Y2K38Warning(object):
+    TASK_CONCURRENT = ('every_second',)    # a post can take over a second: don't queue the next one behind it
+
     def __init__(self, name, api=None):
         self.name = name
         self.log = logging.getLogger(__name__)
@@ -1,53 +1,66 @@
 #!/usr/bin/env python
 
 import datetime
+import functools
 
 import dateutil.easter
-import dateutil.relativedelta
 
 class Holidays(object):
-    def __init__(self, year, *rules):
-        self.rules = rules
-        self._year = None
+    # RULES: (name, f(year, easter)) in order of precedence, f giving the date of
+    # the holiday in that year or None; a year's holidays are computed once into
+    # a {(month, day): name} table, shared by all instances through an LRU
+    RULES = []
+    CACHE_SIZE = 32
+
+    def __init__(self, year):
         self.year = year
 
     def __call__(self, month, day):
-        for (result, test) in self.rules:
-            if test(datetime.date(self.year, month, day)):
-                return result
+        return self.table(self.year).get((month, day))
 
-    @property
-    def year(self):
-        return self._year
+    @classmethod
+    @functools.lru_cache(maxsize=CACHE_SIZE)
+    def table(cls, year):
+        return cls.compute(year)
 
-    @year.setter
-    def year(self, value):
-        if self._year == value:
-            return
-        self._year = value
-        self.easter_date = dateutil.easter.easter(value)
+    @classmethod
+    def compute(cls, year):
+        easter = dateutil.easter.easter(year)
+        table = {}
+        for (name, rule) in cls.RULES:
+            date = rule(year, easter)
+            if date is not None:
+                table.setdefault((date.month, date.day), name)
+        return table
 
-    def day(self, month, day):
-        return datetime.date(self.year, month, day)
+    @classmethod
+    def between(cls, start, end):
+        # [(date, name)] of all holidays in [start, end) in date order, computed in
+        # one pass without going through (and flushing) the LRU
+        holidays = sorted((datetime.date(year, month, day), name) for year in range(start.year, end.year + 1)
+                                                                  for ((month, day), name) in cls.compute(year).items())
+        return [ (date, name) for (date, name) in holidays if start <= date < end ]
 
-    def easter(self, days):
-        return self.easter_date + dateutil.relativedelta.relativedelta(days=days)
+def sunday_before(year, month, day):
+    # the date, moved to the day before when it falls on a Sunday
+    date = datetime.date(year, month, day)
+    return date - datetime.timedelta(days=date.weekday() == 6)
 
-    def is_sunday(self, month, day):
-        return datetime.date(self.year, month, day).weekday() == 6
+def easter(days):
+    return lambda year, easter: easter + datetime.timedelta(days=days)
 
 class NL(Holidays):
-    def __init__(self, year):
-        super(NL, self).__init__(year,
-            ("Nieuwjaarsdag",                   lambda date: date == self.day(1, 1)),
-            ("Eerste Paasdag",                  lambda date: date == self.easter(+0)),
-            ("Tweede Paasdag",                  lambda date: date == self.easter(+1)),
-            ("Koninginnedag",                   lambda date: date == self.day(4, 30 - self.is_sunday(4, 30)) and (1949 <= date.year <= 2013)),
-            ("Koningsdag",                      lambda date: date == self.day(4, 27 - self.is_sunday(4, 27)) and (2014 <= date.year)),
-            ("Dodenherdenking",                 lambda date: date == self.day(5, 4)),
-            ("Bevrijdingsdag",                  lambda date: date == self.day(5, 5)),
-            ("Hemelvaartsdag",                  lambda date: date == self.easter(+39)),
-            ("Eerste Pinksterdag",              lambda date: date == self.easter(+49)),
-            ("Tweede Pinksterdag",              lambda date: date == self.easter(+50)),
-            ("Eerste Kerstdag",                 lambda date: date == self.day(12, 25)),
-            ("Tweede Kerstdag",                 lambda date: date == self.day(12, 26)))
+    RULES = [
+        ("Nieuwjaarsdag",                   lambda year, easter: datetime.date(year, 1, 1)),
+        ("Eerste Paasdag",                  easter(+0)),
+        ("Tweede Paasdag",                  easter(+1)),
+        ("Koninginnedag",                   lambda year, easter: sunday_before(year, 4, 30) if 1949 <= year <= 2013 else None),
+        ("Koningsdag",                      lambda year, easter: sunday_before(year, 4, 27) if 2014 <= year else None),
+        ("Dodenherdenking",                 lambda year, easter: datetime.date(year, 5, 4)),
+        ("Bevrijdingsdag",                  lambda year, easter: datetime.date(year, 5, 5)),
+        ("Hemelvaartsdag",                  easter(+39)),
+        ("Eerste Pinksterdag",              easter(+49)),
+        ("Tweede Pinksterdag",              easter(+50)),
+        ("Eerste Kerstdag",                 lambda year, easter: datetime.date(year, 12, 25)),
+        ("Tweede Kerstdag",                 lambda year, easter: datetime.date(year, 12, 26)),
+    ]
@@ -1,16 +1,44 @@
 
+import functools
 import os
 import time
 import hashlib
 import hmac
-import urllib.request, urllib.parse, urllib.error
+import threading
 import base64
 
-import requests
-
-nonce = lambda n=36: base64.urlsafe_b64encode(os.urandom(n)).decode('ascii')
+class RandomPool(object):
+    # os.urandom() read a block at a time and handed out in slices; a forked
+    # child starts on a block of its own
+    SIZE = 4096
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pid = None
+        self.block = b''
+        self.pos = 0
+
+    def read(self, n):
+        with self.lock:
+            if self.pos + n > len(self.block) or self.pid != os.getpid():
+                self.block = os.urandom(max(self.SIZE, n))
+                self.pos = 0
+                self.pid = os.getpid()
+            self.pos += n
+            return self.block[self.pos - n:self.pos]
+
+random_pool = RandomPool()
+
+nonce = lambda n=36: base64.urlsafe_b64encode(random_pool.read(n)).decode('ascii')
 timestamp = lambda: str(int(time.time()))
-urlencode = lambda s: urllib.parse.quote(s, safe='')
+
+# urllib.parse.quote(s, safe=''), as one str.translate() over the UTF-8 bytes
+# instead of a Python loop per byte
+QUOTE = [ chr(c) if chr(c) in 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789_.-~' else '%{0:02X}'.format(c) for c in range(256) ]
+urlencode = lambda s: (s.encode('utf8') if isinstance(s, str) else s).decode('latin-1').translate(QUOTE)
+# urlencode() of a string that is already encoded apart from its '=' and '&'
+requote = lambda s: s.replace('%', '%25').replace('=', '%3D').replace('&', '%26')
+urlencode_cached = functools.lru_cache(maxsize=1024)(urlencode)     # for parameter names, urls and other repeated strings
 urlencode_dict = lambda d: '&'.join('{0}={1}'.format(urlencode(k), urlencode(d[k])) for k in sorted(d.keys()))
 
 def hmac_sha1(key, s):
@@ -25,6 +53,7 @@ class Oauth1(object):
         self.nonce = nonce
         self.timestamp = timestamp
 
+        import requests                     # deferred: it is most of the startup time
         self.session = requests.Session()
         self.stream = stream
 
@@ -32,6 +61,7 @@ class Oauth1(object):
         self.log_response = lambda response: None
 
     def _create_request(self, method, url, get, post, headers):
+        import requests
         desturl = (url + '?' + urlencode_dict(get)) if get else url
         request = requests.Request(method, desturl, headers=headers, data=(post if post else None))
         request = self.session.prepare_request(request)
@@ -45,6 +75,19 @@ class Oauth1(object):
         self.log_response(response)
         return response
 
+    def _static(self):
+        # signing key, HMAC primed with it (cloned per signature) and the encoded
+        # key=value of the oauth parameters that are the same for every request;
+        # rebuilt if the credentials are changed
+        credentials = (self.consumer_key, self.consumer_secret, self.token, self.token_secret)
+        if getattr(self, '_static_for', None) != credentials:
+            sig_key = '&'.join([ urlencode(self.consumer_secret), urlencode(self.token_secret) ])
+            static = { 'oauth_consumer_key': self.consumer_key, 'oauth_signature_method': 'HMAC-SHA1', 'oauth_token': self.token, 'oauth_version': '1.0' }
+            self._static_data = (sig_key, hmac.new(sig_key.encode('ascii'), digestmod=hashlib.sha1),
+                                 { k: (v, urlencode(k) + '=' + urlencode(v), k + '="' + urlencode(v) + '"') for (k, v) in static.items() })
+            self._static_for = credentials
+        return self._static_data
+
     def _get_oauth_params(self, get, post):
         oauth = {
             'oauth_consumer_key': self.consumer_key,
@@ -62,21 +105,29 @@ class Oauth1(object):
         return oauth, params
 
     def _get_param_str(self, params):
-        return '&'.join(urlencode(k) + '=' + urlencode(params[k]) for k in sorted(params.keys()))
+        static = self._static()[2]
+        return '&'.join(static[k][1] if k in static and static[k][0] == params[k] else urlencode_cached(k) + '=' + urlencode(params[k])
+                        for k in sorted(params.keys()))
 
     def _get_sig_str(self, method, url, param_str):
-        return '&'.join([ method, urlencode(url), urlencode(param_str) ])
+        return '&'.join([ method, urlencode_cached(url), requote(param_str) ])
 
     def _get_sig_key(self):
-        return '&'.join([ urlencode(self.consumer_secret), urlencode(self.token_secret) ])
+        return self._static()[0]
 
     def _calc_sig(self, sig_key, sig_str):
-        return hmac_sha1(sig_key, sig_str)
+        (key, primed, _) = self._static()
+        if sig_key != key:
+            return hmac_sha1(sig_key, sig_str)
+        h = primed.copy()
+        h.update(sig_str.encode('ascii'))
+        return base64.b64encode(h.digest()).decode('ascii')
 
     def _authorization(self, method, url, get, post):
+        (sig_key, _, static) = self._static()
         oauth, params = self._get_oauth_params(get, post)
         param_str = self._get_param_str(params)
-        sig_str = '&'.join([ method, urlencode(url), urlencode(param_str) ])
-        sig_key = '&'.join([ urlencode(self.consumer_secret), urlencode(self.token_secret) ])
+        sig_str = self._get_sig_str(method, url, param_str)
         oauth['oauth_signature'] = self._calc_sig(sig_key, sig_str)
-        return 'OAuth ' + ', '.join('{0}="{1}"'.format(k, urlencode(oauth[k])) for k in sorted(oauth.keys()))
+        return 'OAuth ' + ', '.join(static[k][2] if k in static and static[k][0] == oauth[k] else '{0}="{1}"'.format(k, urlencode(oauth[k]))
+                                    for k in sorted(oauth.keys()))
@@ -1,42 +1,308 @@
+import bisect
+import calendar
+import collections
+import datetime
+import heapq
+import itertools
 import logging
+import math
+import random
 import re
 import sys
 import time
 import threading, queue
 import traceback
+import types
 
 from . import twitter
 
+FIELDS = 'tm_sec tm_min tm_hour tm_mday tm_mon tm_year tm_wday'.split()
+SIZES  = [62, 60, 24, 32, 13, None, 7]                           # None: sparse (years)
+
+def bits(mask):
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+def owner(action):
+    # the bot of a bound method; builtins like print have a __self__ too (their module)
+    return action.__self__ if isinstance(action, types.MethodType) else None
+
+def serial_key(action):
+    # what keyed queues run one task at a time for: the bot of action, or None
+    # (not serialized) for actions the bot lists in TASK_CONCURRENT
+    bot = owner(action)
+    return None if action.__name__ in getattr(bot, 'TASK_CONCURRENT', ()) else bot
+
+def walk(values, start):
+    # yield every (year, mon, mday, hour, min, sec) >= start allowed by the sorted
+    # per-field values, in order; lower bounds only apply while on the start path
+    secs, mins, hours, mdays, mons, years, wdays = values
+    y0, mo0, d0, h0, mi0, s0 = start
+    for y in years[bisect.bisect_left(years, y0):]:
+        at_y = y == y0
+        for mo in mons[bisect.bisect_left(mons, mo0) if at_y else 0:]:
+            at_mo = at_y and mo == mo0
+            wd1, ndays = calendar.monthrange(y, mo)
+            for d in mdays[bisect.bisect_left(mdays, d0) if at_mo else 0:]:
+                if d > ndays:
+                    break
+                if (wd1 + d - 1) % 7 not in wdays:
+                    continue
+                at_d = at_mo and d == d0
+                for h in hours[bisect.bisect_left(hours, h0) if at_d else 0:]:
+                    at_h = at_d and h == h0
+                    for mi in mins[bisect.bisect_left(mins, mi0) if at_h else 0:]:
+                        at_mi = at_h and mi == mi0
+                        for s in secs[bisect.bisect_left(secs, s0) if at_mi else 0:]:
+                            yield (y, mo, d, h, mi, s)
+
+def span(values):
+    # (first, last) wall time at which a rule can fire, or None if it never can
+    first = next(walk(values, (0, 0, 0, 0, 0, 0)), None)
+    if first is None:
+        return None
+    secs, mins, hours, mdays, mons, years, wdays = values
+    for y in reversed(years):
+        for mo in reversed(mons):
+            wd1, ndays = calendar.monthrange(y, mo)
+            for d in reversed(mdays):
+                if d <= ndays and (wd1 + d - 1) % 7 in wdays:
+                    return (first, (y, mo, d, hours[-1], mins[-1], secs[-1]))
+
+class Timer(object):
+    # a one-shot CronRunner.at() action; cancel() keeps it from firing
+    def __init__(self, when, action, args, kwargs):
+        self.when = when
+        self.action = action
+        self.args = args
+        self.kwargs = kwargs
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def __repr__(self):
+        return '<Timer {0} at {1}>'.format(getattr(self.action, '__qualname__', self.action), time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.when)))
+
+MKTIME = { time.gmtime: calendar.timegm, time.localtime: time.mktime }
+
+class Task(object):
+    def __init__(self, action, args=(), kwargs={}, priority=0, deadline=None, attempt=1):
+        self.action = action
+        self.args = args
+        self.kwargs = kwargs
+        self.priority = priority                                # lower runs first
+        self.deadline = deadline                                # time.monotonic() after which it is stale
+        self.attempt = attempt
+
+    @property
+    def name(self):
+        return getattr(self.action, '__qualname__', repr(self.action))
+
+    def __call__(self):
+        return self.action(*self.args, **self.kwargs)
+
+    def __repr__(self):
+        return f"<Task {self.name} #{self.attempt}>"
+
+class TaskQueue(object):
+    # get() returns the ready task with the lowest (priority, deadline), dropping
+    # tasks whose deadline has passed; put() can delay a task
+    def __init__(self):
+        self.log = logging.getLogger(__name__)
+        self.cond = threading.Condition()
+        self.ready = []                                         # heap of (priority, deadline, seq, task)
+        self.delayed = []                                       # heap of (due, seq, task)
+        self.seq = itertools.count()
+        self.dropped = collections.Counter()
+
+    def put(self, task, delay=0):
+        with self.cond:
+            now = time.monotonic()
+            if task is None:
+                self.push_stop()
+            elif self.stale(task, now + delay):
+                return
+            elif delay > 0:
+                heapq.heappush(self.delayed, (now + delay, next(self.seq), task))
+            else:
+                self.push_ready(task)
+            self.cond.notify()
+
+    def push_ready(self, task):
+        deadline = math.inf if task.deadline is None else task.deadline
+        heapq.heappush(self.ready, (task.priority, deadline, next(self.seq), task))
+
+    def push_stop(self):
+        heapq.heappush(self.ready, (math.inf, math.inf, next(self.seq), None))
+
+    def stale(self, task, now):
+        if task.deadline is None or task.deadline >= now:
+            return False
+        self.log.info('Dropping %r, %.3f s past its deadline', task, now - task.deadline)
+        self.dropped[task.name] += 1
+        return True
+
+    def get(self):
+        with self.cond:
+            while True:
+                now = time.monotonic()
+                while self.delayed and self.delayed[0][0] <= now:
+                    self.push_ready(heapq.heappop(self.delayed)[2])
+                while self.ready:
+                    task = heapq.heappop(self.ready)[3]
+                    if task is None or not self.stale(task, now):
+                        return task
+                self.cond.wait((self.delayed[0][0] - now) if self.delayed else None)
+
+    def done(self, task):
+        pass
+
+    def qsize(self):
+        with self.cond:
+            return len(self.ready) + len(self.delayed)
+
+class KeyedTaskQueue(TaskQueue):
+    # TaskQueue that runs one task per owner at a time: get() skips owners whose
+    # previous task hasn't been done() yet, so a bot's actions never overlap while
+    # idle workers take tasks of any other bot. Tasks without an owner, or listed
+    # in its TASK_CONCURRENT, aren't serialized.
+    def __init__(self):
+        super(KeyedTaskQueue, self).__init__()
+        self.ready = {}                                         # owner -> heap of (priority, deadline, seq, queued, task)
+        self.busy = {}                                          # owner -> time.monotonic() its task was taken
+        self.stops = 0
+        self.blocked = collections.Counter()                    # owner name -> seconds ready tasks waited on a busy owner
+        self.max_depth = collections.Counter()
+
+    def push_ready(self, task):
+        key = serial_key(task.action)
+        deadline = math.inf if task.deadline is None else task.deadline
+        heap = self.ready.setdefault(key, [])
+        heapq.heappush(heap, (task.priority, deadline, next(self.seq), time.monotonic(), task))
+        name = self.key_name(key)
+        self.max_depth[name] = max(self.max_depth[name], len(heap))
+
+    def push_stop(self):
+        self.stops += 1
+
+    def key_name(self, key):
+        return getattr(key, 'name', '')
+
+    def get(self):
+        with self.cond:
+            while True:
+                now = time.monotonic()
+                while self.delayed and self.delayed[0][0] <= now:
+                    self.push_ready(heapq.heappop(self.delayed)[2])
+                best = None                                     # (entry, owner)
+                for (key, heap) in self.ready.items():
+                    if key is not None and key in self.busy:
+                        continue
+                    while heap and self.stale(heap[0][4], now):
+                        heapq.heappop(heap)
+                    if heap and (best is None or heap[0] < best[0]):
+                        best = (heap[0], key)
+                if best:
+                    key = best[1]
+                    task = heapq.heappop(self.ready[key])[4]
+                    if not self.ready[key]:
+                        del self.ready[key]
+                    if key is not None:
+                        self.busy[key] = now
+                    return task
+                if self.stops:
+                    self.stops -= 1
+                    return None
+                self.cond.wait((self.delayed[0][0] - now) if self.delayed else None)
+
+    def done(self, task):
+        key = serial_key(task.action)
+        if key is None:
+            return
+        with self.cond:
+            now = time.monotonic()
+            since = self.busy.pop(key, now)
+            for entry in self.ready.get(key, []):
+                self.blocked[self.key_name(key)] += now - max(since, entry[3])
+            self.cond.notify()
+
+    def depth(self):
+        with self.cond:
+            return { self.key_name(key): len(heap) for (key, heap) in self.ready.items() if heap }
+
+    def qsize(self):
+        with self.cond:
+            return sum(len(heap) for heap in self.ready.values()) + len(self.delayed) + self.stops
+
 class CronExecutor(object):
+    RETRY_BASE = 1                                              # seconds before the 2nd attempt, doubling after
+    RETRY_JITTER = 0.5
+
     def __init__(self):
         self.name = 'executor'
         self.log = logging.getLogger(__name__)
-        self.queue = queue.Queue()
+        self.queue = KeyedTaskQueue()
+        self.retried = 0
+        self.failed = 0
+
+    def backoff(self, attempt):
+        return self.RETRY_BASE * 2 ** (attempt - 1) * random.uniform(1 - self.RETRY_JITTER, 1 + self.RETRY_JITTER)
 
     @twitter.task('Executor-{0}')
     def run(self, cancel):
         while True:
-            action = self.queue.get()
-            self.log.debug("%s: %r", threading.current_thread().name, action)
-            if not action:
+            task = self.queue.get()
+            self.log.debug("%s: %r", threading.current_thread().name, task)
+            if not task:
+                if threading.current_thread().name.endswith('-0') and getattr(self.queue, 'blocked', None):
+                    self.log.info('%s: seconds blocked behind a busy bot: %s', self.name, dict(self.queue.blocked))
                 break
+            twitter.worker.attempt = task.attempt
             try:
-                (f, a, k) = action
-                f(*a, **k)
+                task()
+            except twitter.Retry as r:
+                delay = max(r.wait, self.backoff(r.attempt))
+                self.log.info('Retrying %s in %.1f s', task.name, delay)
+                self.retried += 1
+                task.attempt = r.attempt + 1
+                self.queue.put(task, delay=delay)
             except Exception as e:
+                self.failed += 1
                 self.log.exception('Executor caught %s; skipping task', type(e).__name__)
+            finally:
+                twitter.worker.attempt = None
+                self.queue.done(task)
 
 class CronRunner(object):
+    MAX_SLEEP = 60
+
     def __init__(self, name, get_time, queue, *rules):
         self.name = name
         self.get_time = get_time
+        self.mktime = MKTIME.get(get_time, time.mktime)
         self.queue = queue
+        self.fired = 0
+        self.late_max = 0.0
+        self.late_total = 0.0
+        self.timers = []                    # heap of (when, seq, Timer)
+        self.timers_lock = threading.Lock()
+        self.timer_seq = itertools.count()
+        self.wake = lambda: None            # set by run() to cut its sleep short
+        self.disabled = set()
         self.log = logging.getLogger(__name__)
-        self.log.info('--------- --------- --------- --------- --------- --------- --------- ---------------- --------------------------------')
-        self.log.info('seconds   minutes   hours     monthday  month     year      weekday   bot              function                        ')
-        self.log.info('--------- --------- --------- --------- --------- --------- --------- ---------------- --------------------------------')
         self.rules = [ self.parse_rule(*r) for r in rules ]
-        self.log.info('--------- --------- --------- --------- --------- --------- --------- ---------------- --------------------------------')
+        self.compile_rules()
+        self.log.info('--------- --------- --------- --------- --------- --------- --------- ---------------- -------------------------------- -----------------------------------------')
+        self.log.info('seconds   minutes   hours     monthday  month     year      weekday   bot              function                         lifetime                                 ')
+        self.log.info('--------- --------- --------- --------- --------- --------- --------- ---------------- -------------------------------- -----------------------------------------')
+        for ((rule, action), lifetime) in zip(rules, self.spans):
+            lifetime = ' - '.join('{0:04}-{1:02}-{2:02} {3:02}:{4:02}:{5:02}'.format(*wall) for wall in lifetime) if lifetime else 'never'
+            self.log.info('%s %-16s %-32s %s', ' '.join('{0:9}'.format(r) for r in rule.lower().split()), getattr(owner(action), 'name', ''), action.__name__, lifetime)
+        self.log.info('--------- --------- --------- --------- --------- --------- --------- ---------------- -------------------------------- -----------------------------------------')
+        self.log.info('%s: %d of %d rules live', self.name, self.active(), len(self.rules))
 
     def parse_rule(self, rule, action):
         FIRSTS   = '00-00/01 00-00/01 00-00/01 01-01/01 01-01/01 00-99/01 00-06/01'.split()
@@ -45,8 +311,6 @@ class CronRunner(object):
         DAYS     = 'mon tue wed thu fri sat sun'.split()
 
         rule = rule.lower().split()
-        name = action.__self__.name if hasattr(action, '__self__') else ''
-        self.log.info('%s %-16s %-32s', ' '.join('{0:9}'.format(r) for r in rule), name, action.__name__)
 
         # replace * with 00-00/01 on the left side of the first non-*
         for (i, v) in enumerate(rule):
@@ -82,33 +346,250 @@ class CronRunner(object):
         if yt < 101: yt += 2000
         rule[-2] = (yf, yt, ys)
 
-        return (list(rule), action)
+        masks = tuple(sum(1 << x for x in range(f, t, s)) for (f, t, s) in rule)  # one bit per allowed value
 
-    def get_runnable_actions(self, t):
-        check = lambda x, f, t, s: (f <= x < t) and (((x - f) % s) == 0)
+        return (masks, action)
+
+    def compile_rules(self):
+        # index[field][value] has bit i set when rule i allows that value, so the
+        # rules matching a time are the AND of seven lookups
+        self.actions = [ action for (_, action) in self.rules ]
+        self.values = [ tuple(list(bits(mask)) for mask in masks) for (masks, _) in self.rules ]
+        self.day_seconds = [ sorted(h * 3600 + m * 60 + s for h in hours for m in mins for s in secs)
+                             for (secs, mins, hours, *_) in self.values ]
+        self.day_plans = {}
+        self.owners = [ owner(action) for action in self.actions ]
+        # a task is stale once the second (for rules firing several times a minute)
+        # or minute it was scheduled for has passed, unless the bot says otherwise
+        self.deadlines = [ getattr(bot, 'TASK_DEADLINE', 1 if bin(masks[0]).count('1') > 1 else 60)
+                           for ((masks, _), bot) in zip(self.rules, self.owners) ]
+        self.priorities = [ getattr(bot, 'TASK_PRIORITY', 0) for bot in self.owners ]
+        self.enabled = (1 << len(self.rules)) - 1
+        self.spans = [ span(values) for values in self.values ]
+        self.starts = [ s and self.epoch(s[0]) for s in self.spans ]
+        self.bounds = ((math.inf,), ())
+        self.live = None
+        self.refresh(tuple(self.get_time(time.time()))[:6])
+
+    def refresh(self, wall):
+        # index only the rules that are live at wall (past their first firing, not
+        # past their last) and walk only those that can still fire; this holds
+        # until some rule starts or ends, so most calls return right away
+        if self.bounds[0] <= wall < self.bounds[1]:
+            return
+        spans = [ (i, *s) for (i, s) in enumerate(self.spans) if s ]
+        # a wall time is past last exactly when it is >= last + (0,)
+        self.bounds = (max([ first for (_, first, _) in spans if first <= wall ] + [ last + (0,) for (_, _, last) in spans if last < wall ], default=()),
+                       min([ first for (_, first, _) in spans if first > wall ] + [ last + (0,) for (_, _, last) in spans if last >= wall ], default=(math.inf,)))
+        live = [ i for (i, first, last) in spans if first <= wall <= last ]
+        if self.live is not None and live != self.live:
+            self.log.info('%s: %d of %d rules live at %s', self.name, len(live), len(self.rules), '{0:04}-{1:02}-{2:02} {3:02}:{4:02}:{5:02}'.format(*wall))
+        self.live = live
+        # live rules first, then the ones still to start in order of their first firing
+        self.remaining = live + sorted((i for (i, first, _) in spans if first > wall), key=self.spans.__getitem__)
+        self.index = [ {} if size is None else [0] * size for size in SIZES ]
+        for i in live:
+            for (index, mask) in zip(self.index, self.rules[i][0]):
+                for x in bits(mask):
+                    if isinstance(index, dict):
+                        index[x] = index.get(x, 0) | (1 << i)
+                    elif x < len(index):
+                        index[x] |= 1 << i
+
+    def active(self):
+        return len(self.live)
+
+    def get_matching_rules(self, t):
+        self.refresh(t[:6])
+        sec, min, hour, mday, mon, year, wday = self.index
+        return (sec[t.tm_sec] & min[t.tm_min] & hour[t.tm_hour] & mday[t.tm_mday]
+                & mon[t.tm_mon] & wday[t.tm_wday] & year.get(t.tm_year, 0))
+
+    def dedup(self, rules):
+        # rule indices in order -> actions, skipping consecutive rules of the same owner
         prev_owner = object()
-        curr_owner = None
-        for rule, action in self.rules:
-            values = list(zip([t.tm_sec, t.tm_min, t.tm_hour, t.tm_mday, t.tm_mon, t.tm_year, t.tm_wday], rule))
-            if all(check(x, *r) for (x, r) in values):
-                curr_owner = action.__self__ if hasattr(action, '__self__') else None
-                if curr_owner != prev_owner:
-                    prev_owner = curr_owner
-                    yield action
+        for i in rules:
+            curr_owner = self.owners[i]
+            if curr_owner != prev_owner:
+                prev_owner = curr_owner
+                yield i
+
+    def get_runnable_rules(self, t):
+        return self.dedup(bits(self.get_matching_rules(t) & self.enabled))
+
+    def rules_of(self, bot):
+        return sum(1 << i for (i, o) in enumerate(self.owners) if o is bot)
+
+    def disable(self, bot):
+        if self.enabled & self.rules_of(bot):
+            self.log.warning('%s: disabling %s', self.name, getattr(bot, 'name', bot))
+        self.enabled &= ~self.rules_of(bot)
+        self.disabled.add(bot)
+
+    def enable(self, bot):
+        self.enabled |= self.rules_of(bot)
+        self.disabled.discard(bot)
+
+    def at(self, when, action, *args, **kwargs):
+        # run action(t, *args, **kwargs) once, at the first whole second >= when
+        # (epoch seconds); safe to call from any thread
+        timer = Timer(math.ceil(when), action, args, kwargs)
+        with self.timers_lock:
+            heapq.heappush(self.timers, (timer.when, next(self.timer_seq), timer))
+            first = self.timers[0][2] is timer
+        self.log.debug('%s: added %r', self.name, timer)
+        if first:
+            self.wake()
+        return timer
+
+    def next_timer(self):
+        with self.timers_lock:
+            while self.timers and self.timers[0][2].cancelled:
+                heapq.heappop(self.timers)
+            return self.timers[0][0] if self.timers else None
+
+    def pop_timers(self, due):
+        with self.timers_lock:
+            timers = []
+            while self.timers and self.timers[0][0] <= due:
+                timers.append(heapq.heappop(self.timers)[2])
+        return [ timer for timer in timers if not timer.cancelled ]
+
+    def get_runnable_actions(self, t):
+        for i in self.get_runnable_rules(t):
+            yield self.actions[i]
+
+    def day_plan(self, rules):
+        # merged, deduplicated (second of day, offset, [(bot, action)]) for a set of
+        # rules; most days share the same set, so plans are cached
+        if rules not in self.day_plans:
+            at = {}
+            for i in rules:
+                for sec in self.day_seconds[i]:
+                    at.setdefault(sec, []).append(i)
+            self.day_plans[rules] = [ (sec, datetime.timedelta(seconds=sec), [ (self.owners[i], self.actions[i]) for i in self.dedup(at[sec]) ])
+                                      for sec in sorted(at) ]
+        return self.day_plans[rules]
+
+    def upcoming(self, start, end):
+        # (datetime, bot, action) for every firing in [start, end), in the runner's
+        # own wall clock, without sleeping or touching the queue
+        with self.timers_lock:
+            timers = sorted(self.timers)
+        timers = [ (datetime.datetime(*self.get_time(when)[:6]), owner(timer.action), timer.action) for (when, _, timer) in timers if not timer.cancelled ]
+        timers = [ timer for timer in timers if start <= timer[0] < end ]
+        return heapq.merge(self.upcoming_rules(start, end), timers, key=lambda firing: firing[0])
+
+    def upcoming_rules(self, start, end):
+        day, last = start.date(), end.date()
+        first_sec = start.hour * 3600 + start.minute * 60 + start.second
+        last_sec = end.hour * 3600 + end.minute * 60 + end.second
+        while day <= last:
+            plan = self.day_plan(tuple(i for (i, (masks, _)) in enumerate(self.rules)
+                                       if masks[3] >> day.day & masks[4] >> day.month & masks[5] >> day.year & masks[6] >> day.weekday() & 1))
+            lo = bisect.bisect_left(plan, (first_sec,)) if day == start.date() else 0
+            hi = bisect.bisect_left(plan, (last_sec,)) if day == last else len(plan)
+            midnight = datetime.datetime(day.year, day.month, day.day)
+            for (_, offset, actions) in plan[lo:hi]:
+                dt = midnight + offset
+                for (bot, action) in actions:
+                    yield (dt, bot, action)
+            day += datetime.timedelta(days=1)
+
+    def epoch(self, wall):
+        return int(self.mktime(wall + (0, 0, -1)))
+
+    def next_fire(self, now):
+        # first second >= now at which any rule fires; wall times that don't exist
+        # or that map back before now (DST changes) are skipped
+        start = tuple(self.get_time(now))[:6]
+        self.refresh(start)
+        due = None
+        for i in self.remaining:
+            if due is not None and self.starts[i] >= due:
+                break
+            for wall in walk(self.values[i], start):
+                t = self.epoch(wall)
+                if due is not None and t >= due:
+                    break
+                if t >= now and tuple(self.get_time(t))[:6] == wall:
+                    due = t
+                    break
+        when = self.next_timer()
+        if when is not None and (due is None or when < due):
+            due = max(when, now)            # a timer that was missed fires right away
+        return due
+
+    def fire(self, due, late, record=True):
+        t = self.get_time(due)
+        for i in self.get_runnable_rules(t):
+            deadline = time.monotonic() - late + self.deadlines[i]
+            self.queue.put(Task(self.actions[i], [t], {}, priority=self.priorities[i], deadline=deadline))
+        for timer in self.pop_timers(due):
+            bot = owner(timer.action)
+            # a bot's housekeeping (e.g. a timer that re-arms itself) never goes
+            # stale and runs while the bot is disabled, or it would be lost for good
+            chore = timer.action.__name__ in getattr(bot, 'HOUSEKEEPING', ())
+            if bot in self.disabled and not chore:
+                self.log.info('%s: dropping %r of disabled %s', self.name, timer, getattr(bot, 'name', bot))
+                continue
+            deadline = None if chore else time.monotonic() - late + getattr(bot, 'TASK_DEADLINE', 60)
+            self.queue.put(Task(timer.action, [t, *timer.args], timer.kwargs, priority=getattr(bot, 'TASK_PRIORITY', 0), deadline=deadline))
+        if record:
+            self.fired += 1
+            self.late_total += late
+            self.late_max = max(self.late_max, late)
+        self.log.debug('%s: fired %s, %.1f ms late', self.name, time.strftime('%H:%M:%S', t), late * 1000)
+
+    def jitter(self):
+        return (self.fired, (self.late_total / self.fired) if self.fired else 0.0, self.late_max)
 
     @twitter.task('Runner-{0}')
     def run(self, cancel):
+        # at() wakes the runner through the cancellation event; only the
+        # canceled flag means stop
+        self.wake = cancel.event.set
         try:
-            prev = None
+            now = start = int(time.time())
             while not cancel:
-                t = self.get_time()
-                if t.tm_sec == prev:
-                    time.sleep(0.2)
+                cancel.event.clear()
+                if cancel:
+                    break
+                due = self.next_fire(now)
+                if due is None:
+                    self.log.info('%s: no more rules can fire', self.name)
+                    cancel.wait()
+                    now = int(time.time())
+                    continue
+
+                # sleep on the monotonic clock, but wake up at least every
+                # MAX_SLEEP seconds to notice wall clock changes
+                deadline = time.monotonic() + (due - time.time())
+                while not cancel and (remaining := deadline - time.monotonic()) > 0:
+                    if cancel.wait(min(remaining, self.MAX_SLEEP)):
+                        break
+                    if abs((deadline - time.monotonic()) - (due - time.time())) > 1:
+                        break
+                if cancel:
+                    break
+                if cancel.event.is_set() and time.time() < due:   # woken by at(): look again
+                    now = int(time.time())
                     continue
-                prev = t.tm_sec
-                for action in self.get_runnable_actions(t):
-                    self.queue.put((action, [t], {}))
+
+                late = time.time() - due
+                if late < 0:
+                    now = int(time.time())
+                    continue
+                if late >= 1:
+                    self.log.warning('%s: missed %s by %.1f s, skipping', self.name, time.strftime('%H:%M:%S', self.get_time(due)), late)
+                    now = int(time.time())
+                    continue
+
+                self.fire(due, late, record=due > start)       # the second we started in is always late
+                now = due + 1
         finally:
+            count, mean, worst = self.jitter()
+            self.log.info('%s: fired %d times, lateness mean %.1f ms, max %.1f ms', self.name, count, mean * 1000, worst * 1000)
             if threading.current_thread().name.endswith('-0'):
                 target_len = self.queue.qsize() + 10
                 while self.queue.qsize() < target_len:
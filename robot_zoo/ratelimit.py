@@ -0,0 +1,69 @@
+import threading
+import time
+
+HEADERS = ('x-rate-limit-limit', 'x-rate-limit-remaining', 'x-rate-limit-reset')
+
+class Bucket(object):
+    def __init__(self, limit=None, window=None):
+        self.limit = limit
+        self.window = window                # None: limit/remaining/reset come from headers
+        self.remaining = limit
+        self.reset = 0
+
+    def wait(self, now):
+        if self.reset <= now:
+            self.remaining = self.limit
+            self.reset = (now + self.window) if self.window else 0
+        if self.remaining is None or self.remaining > 0:
+            return 0
+        return self.reset - now
+
+    def take(self):
+        if self.remaining is not None:
+            self.remaining -= 1
+
+    def update(self, limit, remaining, reset):
+        self.limit = limit
+        self.remaining = remaining
+        self.reset = reset
+
+    def state(self):
+        return (self.limit, self.remaining, self.reset)
+
+class RateLimiter(object):
+    def __init__(self, get_time=time.time):
+        self.get_time = get_time
+        self.lock = threading.Lock()
+        self.buckets = {}
+
+    def budget(self, key, limit, window):
+        # a fixed local budget, for limits twitter doesn't report in headers
+        with self.lock:
+            if key not in self.buckets:
+                self.buckets[key] = Bucket(limit, window)
+
+    def reserve(self, keys):
+        # take one request from every bucket, or return the seconds to wait
+        # before that is possible (taking nothing)
+        with self.lock:
+            now = self.get_time()
+            buckets = [ self.buckets.setdefault(key, Bucket()) for key in keys ]
+            wait = max(bucket.wait(now) for bucket in buckets)
+            if wait <= 0:
+                for bucket in buckets:
+                    bucket.take()
+            return wait
+
+    def update(self, key, headers):
+        try:
+            limit, remaining, reset = (int(headers[h]) for h in HEADERS)
+        except (KeyError, TypeError, ValueError):
+            return
+        with self.lock:
+            self.buckets.setdefault(key, Bucket()).update(limit, remaining, reset)
+
+    def state(self, key=None):
+        with self.lock:
+            if key is not None:
+                return self.buckets[key].state() if key in self.buckets else (None, None, 0)
+            return { key: bucket.state() for (key, bucket) in self.buckets.items() }
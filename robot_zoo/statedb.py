@@ -0,0 +1,129 @@
+import contextlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+
+class StateDB:
+    # one SQLite database (WAL mode) for the state of all bots: every thread
+    # reads on its own connection, writers take turns, and a transaction can
+    # span the saves of several bots
+    instances = {}
+    instances_lock = threading.Lock()
+
+    @classmethod
+    def open(cls, path):
+        with cls.instances_lock:
+            if path not in cls.instances:
+                cls.instances[path] = cls(path)
+            return cls.instances[path]
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        with self.transaction() as db:
+            db.execute('CREATE TABLE IF NOT EXISTS state (bot TEXT, key TEXT, value TEXT NOT NULL, PRIMARY KEY (bot, key)) WITHOUT ROWID')
+
+    def connection(self):
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, isolation_level=None, timeout=30)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            self.local.db = db
+            self.local.depth = 0
+            self.local.committed = []
+        return db
+
+    @contextlib.contextmanager
+    def transaction(self):
+        # nests: only the outermost transaction commits
+        db = self.connection()
+        if not self.local.depth:
+            db.execute('BEGIN IMMEDIATE')
+        self.local.depth += 1
+        try:
+            yield db
+        except BaseException:
+            self.local.depth -= 1
+            if not self.local.depth:
+                db.execute('ROLLBACK')
+                self.local.committed = []
+            raise
+        self.local.depth -= 1
+        if not self.local.depth:
+            db.execute('COMMIT')
+            (committed, self.local.committed) = (self.local.committed, [])
+            for f in committed:
+                f()
+
+    def on_commit(self, f):
+        # call f once the outermost transaction has committed
+        self.connection()
+        if self.local.depth:
+            self.local.committed.append(f)
+        else:
+            f()
+
+    def get(self, bot, key):
+        row = self.connection().execute('SELECT value FROM state WHERE bot = ? AND key = ?', (bot, key)).fetchone()
+        return row[0] if row else None
+
+    def put(self, bot, items):
+        with self.transaction() as db:
+            db.executemany('INSERT OR REPLACE INTO state (bot, key, value) VALUES (?, ?, ?)', [ (bot, k, v) for (k, v) in items ])
+
+    def keys(self, bot):
+        return [ k for (k,) in self.connection().execute('SELECT key FROM state WHERE bot = ?', (bot,)) ]
+
+    def close(self):
+        db = getattr(self.local, 'db', None)
+        if db is not None:
+            db.close()
+            self.local.db = None
+
+class DBConfiguration:
+    # twitter.Configuration on a StateDB: keys are read when first used and
+    # save() writes only the keys whose value changed
+    def __init__(self, db, bot, log=None, default=lambda: None, config_file=None):
+        self.db = db
+        self.bot = bot
+        self.log = log if log else logging.getLogger(__name__)
+        self.default = default
+        self.config_file = config_file      # JSON state to migrate from
+        self.cache = {}                     # key -> value
+        self.written = {}                   # key -> value as stored
+        self.migrate()
+
+    def __getitem__(self, name):
+        if name not in self.cache:
+            data = self.db.get(self.bot, name)
+            if data is None:
+                self.cache[name] = (self.default() or {})[name]
+            else:
+                self.cache[name] = json.loads(data)
+                self.written[name] = data
+        return self.cache[name]
+
+    def __setitem__(self, name, value):
+        self.cache[name] = value
+
+    def migrate(self):
+        if not self.config_file or not os.path.exists(self.config_file) or self.db.keys(self.bot):
+            return
+        self.log.info('Moving %s into %s', self.config_file, self.db.path)
+        with open(self.config_file, 'rb') as f:
+            config = json.load(f)
+        self.db.put(self.bot, [ (k, json.dumps(v)) for (k, v) in config.items() ])
+        os.replace(self.config_file, self.config_file + '.migrated')
+
+    def save(self):
+        changed = [ (k, data) for (k, data) in ((k, json.dumps(v)) for (k, v) in self.cache.items()) if data != self.written.get(k) ]
+        if changed:
+            with self.db.transaction():
+                self.db.put(self.bot, changed)
+                self.db.on_commit(lambda: self.written.update(changed))
+
+    def flush(self):
+        pass
@@ -1,33 +1,62 @@
 
+import atexit
+import concurrent.futures
 import ctypes
+import hashlib
 import json
-import urllib.request, urllib.parse, urllib.error
-import urllib.request, urllib.error, urllib.parse
 import re
 import time
 import sys
 import threading
-import urllib.request, urllib.error, urllib.parse, base64, json, threading, queue
+import weakref
 import functools
 import logging
 import platform
 import os
 
-import prctl
-import requests
-
 from . import oauth1
+from . import ratelimit
+from . import statedb
 
 class FailWhale(Exception):
     def log_error(self, obj):
         obj.error('FAIL WHALE: {0}', str(self))
 
+class RateLimited(FailWhale):
+    def __init__(self, message, wait=0):
+        super(RateLimited, self).__init__(message)
+        self.wait = wait
+
+class Retry(Exception):
+    def __init__(self, error, attempt):
+        super(Retry, self).__init__(error, attempt)
+        self.error = error
+        self.attempt = attempt
+        self.wait = getattr(error, 'wait', 0)
+
+RETRIES = 5
+
+worker = threading.local()      # worker.attempt is set by executors that reschedule retries themselves
+
 def retry(f):
     @functools.wraps(f)
     def retry(self, *a, **k):
+        attempt = getattr(worker, 'attempt', None)
+        if attempt is not None:
+            # inside an executor: try once and let it schedule the next attempt,
+            # instead of sleeping in the worker thread
+            try:
+                if attempt > 1:
+                    self.log.info('Attempt %d', attempt)
+                return f(self, *a, **k)
+            except FailWhale as e:
+                self.log.error("Retry caught %s - %r", type(e).__name__, e)
+                if attempt >= RETRIES:
+                    return None
+                raise Retry(e, attempt)
         t = 1
         i = 1
-        while t < 32:
+        while i <= RETRIES:
             try:
                 if i > 1:
                     self.log.info('Attempt %d, t=%d', i, t)
@@ -40,11 +69,16 @@ def retry(f):
     return retry
 
 class Cancellation:
-    canceled = False
+    def __init__(self):
+        self.canceled = False
+        self.event = threading.Event()
     def __bool__(self):
         return self.canceled
     def cancel(self):
         self.canceled = True
+        self.event.set()
+    def wait(self, timeout=None):
+        return self.event.wait(timeout)
 
 def task(name):
     def task(f):
@@ -52,6 +86,7 @@ def task(name):
         def task(self, count=1):
             def run():
                 try:
+                    import prctl
                     prctl.set_name(threading.current_thread().name)
                     logging.getLogger(__name__).info('Starting, #%d', gettid())
                     f(self, cancel)
@@ -77,12 +112,105 @@ def gettid():
         return -1
     return ctypes.CDLL('libc.so.6').syscall(gettid[machine])
 
+def write_atomic(path, data):
+    # readers (and a restart after a crash) see either the old or the new file
+    with open(path + '.tmp', 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + '.tmp', path)
+
+class Flusher:
+    # writes saved configurations in the background, at most Configuration.delay
+    # seconds after the first save since the last write
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.due = {}                       # configuration -> time.monotonic() to write it
+        self.thread = None
+
+    def schedule(self, config, delay):
+        with self.cond:
+            if config not in self.due:
+                self.due[config] = time.monotonic() + delay
+            if not self.thread:
+                self.thread = threading.Thread(name='Flusher', target=self.run, daemon=True)
+                self.thread.start()
+            self.cond.notify()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.due or min(self.due.values()) > time.monotonic():
+                    self.cond.wait((min(self.due.values()) - time.monotonic()) if self.due else None)
+                now = time.monotonic()
+                configs = [ config for (config, due) in self.due.items() if due <= now ]
+                for config in configs:
+                    del self.due[config]
+            for config in configs:
+                try:
+                    config.flush()
+                except Exception as e:
+                    config.log.exception('Flusher caught %s saving %s', type(e).__name__, config.config_file)
+
+    def flush(self):
+        with self.cond:
+            configs = [*self.due]
+            self.due.clear()
+        for config in configs:
+            config.flush()
+
+flusher = Flusher()
+flush = flusher.flush
+atexit.register(flush)
+
+class Watcher:
+    # polls watched configuration files and reloads the ones that changed
+    INTERVAL = 2
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.configs = weakref.WeakSet()
+        self.thread = None
+
+    def watch(self, config):
+        with self.lock:
+            self.configs.add(config)
+            if not self.thread:
+                self.thread = threading.Thread(name='Watcher', target=self.run, daemon=True)
+                self.thread.start()
+
+    def run(self):
+        while True:
+            time.sleep(self.INTERVAL)
+            self.poll()
+
+    def poll(self):
+        with self.lock:
+            configs = [*self.configs]
+        for config in configs:
+            try:
+                config.reload()
+            except Exception as e:
+                config.log.exception('Watcher caught %s reloading %s', type(e).__name__, config.config_file)
+
+watcher = Watcher()
+
 class Configuration:
-    def __init__(self, config_file, log, default=lambda: None):
+    SAVE_DELAY = 5                          # seconds a save may wait to be coalesced with later ones
+
+    def __init__(self, config_file, log, default=lambda: None, delay=None, watch=False):
         self.config_file = config_file
         self.log = log
         self.default = default
+        self.delay = self.SAVE_DELAY if delay is None else delay
+        self.lock = threading.Lock()
+        self.pending = None                 # serialized config waiting to be written
+        self.written = None                 # serialized config as it is on disk
+        self.stat = None                    # (inode, mtime, size) of the file as loaded or written
+        self.listeners = []
         self.load()
+        if watch and config_file:
+            watcher.watch(self)
 
     def __getitem__(self, name):
         return self.config[name]
@@ -90,78 +218,329 @@ class Configuration:
     def __setitem__(self, name, value):
         self.config[name] = value
 
+    def file_stat(self):
+        try:
+            st = os.stat(self.config_file)
+        except FileNotFoundError:
+            return None
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+
     def load(self):
         if self.config_file:
             self.log.info('Loading %s', self.config_file)
             try:
+                self.stat = self.file_stat()
                 with open(self.config_file, 'rb') as f:
-                    self.config = json.load(f)
+                    self.written = f.read()
+                self.config = json.loads(self.written)
             except IOError as e:
                 self.log.warn(f"WARNING: caught {type(e)} ({e}) when loading {self.config_file}, using default")
                 self.config = self.default()
 
+    def on_reload(self, f):
+        # f(old, new) is called after the file changed and was loaded
+        self.listeners.append(f)
+
+    def reload(self):
+        # swaps in the changed file as a new dict, so code still holding values
+        # of the old one keeps a consistent snapshot; a file that doesn't parse
+        # is left alone until it changes again
+        stat = self.file_stat()
+        if stat == self.stat or stat is None:
+            return False
+        self.stat = stat
+        with open(self.config_file, 'rb') as f:
+            data = f.read()
+        try:
+            config = json.loads(data)
+        except ValueError as e:
+            self.log.error('Not reloading %s: %s', self.config_file, e)
+            return False
+        with self.lock:
+            (old, self.config) = (self.config, config)
+            (self.written, self.pending) = (data, None)
+        self.log.info('Reloaded %s', self.config_file)
+        for f in self.listeners:
+            f(old, config)
+        return True
+
     def save(self):
+        # cheap: serializes a snapshot and leaves writing it to the flusher;
+        # nothing is written when the config didn't change
         if self.config_file:
+            data = json.dumps(self.config, indent=4).encode('utf8')
+            with self.lock:
+                if data == (self.written if self.pending is None else self.pending):
+                    return
+                self.pending = data
+            if self.delay > 0:
+                flusher.schedule(self, self.delay)
+            else:
+                self.flush()
+
+    def flush(self):
+        with self.lock:
+            if self.pending is None or self.pending == self.written:
+                self.pending = None
+                return
             self.log.info('Saving %s', self.config_file)
-            with open(self.config_file, 'wb') as f:
-                json.dump(self.config, f, indent=4)
+            write_atomic(self.config_file, self.pending)
+            (self.written, self.pending) = (self.pending, None)
+            self.stat = self.file_stat()
+
+READ_ONLY = False                           # set by the schedule dry run: state is read, never written
+
+def open_state(name, log, default=lambda: None):
+    # bot state: a SQLite database shared by all bots (migrating <name>.state.json
+    # on first use), or with ROBOT_ZOO_STATE_BACKEND=json one JSON file per bot.
+    # JSON state is only written when saved, so READ_ONLY uses that.
+    state_dir = os.environ.get('ROBOT_ZOO_STATE_DIR', '.')
+    config_file = f"{state_dir}/{name}.state.json"
+    if READ_ONLY or os.environ.get('ROBOT_ZOO_STATE_BACKEND', 'sqlite') == 'json':
+        return Configuration(config_file=config_file, log=log, default=default)
+    return statedb.DBConfiguration(statedb.StateDB.open(f"{state_dir}/robot_zoo.db"), name, log, default, config_file)
+
+def read_chunks(raw, size):
+    # what has arrived of a streamed (urllib3) response, up to size bytes at a
+    # time; unlike read(size) this doesn't wait for size bytes to come in
+    if hasattr(raw, 'read1'):
+        return iter(functools.partial(raw.read1, size, decode_content=True), b'')
+    return raw.stream(size, decode_content=True)
+
+class MessageSplitter:
+    # the messages in a stream of byte chunks: lines, with b'' for keep-alive
+    # newlines, or with delimited (delimited=length streams) the number of bytes
+    # given on each length line. Chunks are collected in one bytearray that each
+    # message is copied out of once; a partial line or frame waits for more chunks.
+    def __init__(self, delimited=False):
+        self.delimited = delimited
+        self.buf = bytearray()
+        self.scan = 0                       # where to look for the next newline
+        self.size = None                    # length of the frame being read
+
+    def feed(self, chunk):
+        # the messages completed by chunk; to be consumed before the next feed()
+        buf = self.buf
+        buf += chunk
+        pos = 0
+        with memoryview(buf) as view:
+            while True:
+                if self.size is not None:
+                    if len(buf) - pos < self.size:
+                        break
+                    end = pos + self.size
+                    while end > pos and buf[end - 1] in b'\r\n':
+                        end -= 1
+                    yield bytes(view[pos:end])
+                    pos = self.scan = pos + self.size
+                    self.size = None
+                    continue
+                nl = buf.find(b'\n', self.scan)
+                if nl < 0:
+                    self.scan = len(buf)
+                    break
+                end = nl - 1 if nl > pos and buf[nl - 1] == 13 else nl
+                if self.delimited and end > pos:
+                    self.size = int(view[pos:end])
+                else:
+                    yield bytes(view[pos:end])
+                pos = self.scan = nl + 1
+        del buf[:pos]
+        self.scan -= pos
+
+    def end(self):
+        # a last line without newline; a partial frame is dropped
+        if self.buf and self.size is None:
+            yield bytes(self.buf)
+
+def split_messages(chunks, delimited=False):
+    splitter = MessageSplitter(delimited)
+    for chunk in chunks:
+        yield from splitter.feed(chunk)
+    yield from splitter.end()
+
+class Endpoint:
+    def __init__(self, name, method, path, host, version, stream):
+        self.name = name                    # e.g. post_statuses_update
+        self.method = method                # e.g. POST
+        self.path = path                    # e.g. statuses/update
+        self.stream = stream
+        self.bucket = f"/{path}"            # rate limit resource, as in x-rate-limit headers
+        self.base = f"https://{host}/{version}/{path}" if path else f"https://{host}/{version}"
+
+    def url(self, args=()):
+        if not args:
+            return self.base + '.json'
+        return self.base + ''.join(f"/{arg}" for arg in map(str, args) if arg) + '.json'
+
+    def __repr__(self):
+        return f"<Endpoint {self.method} {self.path}>"
 
 class TwitterAPI:
     API_VERSION = '1.1'
     API_HOST = 'api.twitter.com'
     API_STREAM = False
 
+    POOL_SIZE = 4                           # connections kept per account
+    POOL_IDLE = 60                          # seconds before idle connections are dropped
+    STREAM_BUFFER = 64 * 1024               # most bytes of a stream read at once
+
+    RATE_LIMIT_WAIT = 60                    # longest wait for a rate limit before giving up
+    APP_LIMITS = {                          # per consumer key, not reported in headers
+        '/statuses/update': (300, 3 * 3600),
+    }
+
+    rate_limiter = ratelimit.RateLimiter()  # shared by all accounts in the process
+
     API_REGEX = r'^(get|post|put|delete)_(statuses|search|direct_messages|followers|friendships|friends|users|favorites|lists|account|saved_searches|trends|geo|blocks|notifications)(.*)'
     API_REGEX = re.compile(API_REGEX)
 
     def __init__(self, name, log=None):
         self.name = '@{0}'.format(name)
         self.log = log if log else logging.getLogger(__name__)
-        self.config = Configuration(f"{os.environ.get('ROBOT_ZOO_CONFIG_DIR', 'cfg')}/{name}.json", self.log)
+        self.config = Configuration(f"{os.environ.get('ROBOT_ZOO_CONFIG_DIR', 'cfg')}/{name}.json", self.log, watch=True)
+        self.config.on_reload(self.config_reloaded)
+        self.client = None
+        self.client_lock = threading.Lock()
+        self.client_used = 0
+        self.client_busy = 0                # calls using self.client
+        self.retired = {}                   # client replaced while in use -> calls still using it
+
+    def acquire_client(self):
+        # one long-lived client (and keep-alive connection pool) per account, shared
+        # by all threads; dropped after POOL_IDLE seconds without requests
+        with self.client_lock:
+            now = time.monotonic()
+            if self.client and not self.client_busy and now - self.client_used > self.POOL_IDLE:
+                self.log.debug('Closing idle connections of %s', self.name)
+                self.client.session.close()
+                self.client = None
+            if not self.client:
+                import requests.adapters
+                self.client = oauth1.Oauth1(config=self.config['oauth'], stream=self.API_STREAM)
+                self.client.session.mount('https://', requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.POOL_SIZE))
+                self.client.log_request = self.log_request
+                self.client.log_response = self.log_response
+            self.client_busy += 1
+            return self.client
+
+    def release_client(self, client):
+        with self.client_lock:
+            if client is self.client:
+                self.client_busy -= 1
+                self.client_used = time.monotonic()
+                return
+            # replaced by config_reloaded() while in use: the last call closes it
+            self.retired[client] -= 1
+            if not self.retired[client]:
+                del self.retired[client]
+                client.session.close()
+
+    def config_reloaded(self, old, new):
+        # calls in flight finish with the client they have; the next call gets
+        # a client with the new credentials
+        if (old or {}).get('oauth') != new.get('oauth'):
+            self.log.info('Credentials of %s changed', self.name)
+            with self.client_lock:
+                (client, self.client, busy, self.client_busy) = (self.client, None, self.client_busy, 0)
+                if client and busy:
+                    self.retired[client] = busy
+                elif client:
+                    client.session.close()
+
+    @classmethod
+    def endpoint(cls, name):
+        # endpoints are compiled once per class (host and stream-ness differ between
+        # subclasses) and then shared by all instances
+        if 'ENDPOINTS' not in cls.__dict__:
+            cls.ENDPOINTS = {}
+        if name not in cls.ENDPOINTS:
+            match = cls.API_REGEX.match(name)
+            if not match:
+                raise AttributeError(name)
+            method, path, obj = match.groups()
+            cls.ENDPOINTS[name] = Endpoint(name, method.upper(), '/'.join(p for p in [path, obj[1:]] if p),
+                                           cls.API_HOST, cls.API_VERSION, cls.API_STREAM)
+        return cls.ENDPOINTS[name]
 
     def __getattr__(self, name):
-        match = self.API_REGEX.match(name)
-        if not match:
-            raise AttributeError(name)
-
-        method, path, obj = match.groups()
-        method = method.upper()
-
-        obj = obj[1:]
-
-        def generate_caller(method, path, obj):
-            def caller(*args, **kwargs):
-                args = list(map(str, args))
-                kwargs = { k: str(v).encode('utf8') for (k, v) in kwargs.items() }
-                url = ('https://'
-                    + self.API_HOST
-                    + '/'
-                    + '/'.join(item for item in ([self.API_VERSION] + [path, obj] + args) if item)
-                    + '.json')
-                content = None
-                try:
-                    self.log.debug('--> %s: %s', name, url)
-                    client = oauth1.Oauth1(config=self.config['oauth'], stream=self.API_STREAM)
-                    client.log_request = self.log_request
-                    client.log_response = self.log_response
-                    if method == "POST":
-                        response = client.request(method, url, post=kwargs, headers={'Accept': 'application/json'})
-                    else:
-                        response = client.request(method, url, get=kwargs, headers={'Accept': 'application/json'})
-                    self.log.debug('<-- %s: %s', name, response.status_code)
-
-                    if self.API_STREAM:
-                        content = (self.try_json_decode(message) for message in response.iter_lines(chunk_size=1))
-                    else:
-                        content = response.json()
+        endpoint = self.endpoint(name)
+        def caller(*args, **kwargs):
+            return self.call(endpoint, *args, **kwargs)
+        caller.name = name
+        caller.endpoint = endpoint
+        self.__dict__[name] = caller                        # next lookup won't reach __getattr__
+        return caller
+
+    def rate_limit_keys(self, endpoint):
+        keys = [ (self.name, endpoint.bucket) ]
+        if endpoint.bucket in self.APP_LIMITS:
+            key = (self.config['oauth']['consumer_key'], endpoint.bucket)
+            self.rate_limiter.budget(key, *self.APP_LIMITS[endpoint.bucket])
+            keys.append(key)
+        return keys
+
+    def rate_limit(self, name):
+        return self.rate_limiter.state((self.name, self.endpoint(name).bucket))
+
+    def reserve(self, endpoint):
+        # 0 when the request may be sent now, else the seconds to wait first
+        wait = self.rate_limiter.reserve(self.rate_limit_keys(endpoint))
+        if wait > self.RATE_LIMIT_WAIT:
+            raise RateLimited(f"{endpoint.name} rate limited for {wait:.0f} s", wait)
+        if wait > 0:
+            self.log.info('Rate limited on %s, waiting %.1f s', endpoint.name, wait)
+        return wait
+
+    def throttle(self, endpoint):
+        # in an executor worker the task is rescheduled after the wait (through
+        # retry()) instead of sleeping in the worker thread
+        while (wait := self.reserve(endpoint)) > 0:
+            if getattr(worker, 'attempt', None) is not None:
+                raise RateLimited(f"{endpoint.name} rate limited for {wait:.0f} s", wait)
+            time.sleep(wait)
+
+    def call(self, endpoint, *args, **kwargs):
+        kwargs = { k: str(v).encode('utf8') for (k, v) in kwargs.items() }
+        url = endpoint.url(args)
+        content = None
+        try:
+            self.throttle(endpoint)
+            self.log.debug('--> %s: %s', endpoint.name, url)
+            client = self.acquire_client()
+            streaming = False
+            try:
+                if endpoint.method == "POST":
+                    response = client.request(endpoint.method, url, post=kwargs, headers={'Accept': 'application/json'})
+                else:
+                    response = client.request(endpoint.method, url, get=kwargs, headers={'Accept': 'application/json'})
+                self.log.debug('<-- %s: %s', endpoint.name, response.status_code)
+                self.rate_limiter.update((self.name, endpoint.bucket), response.headers)
+
+                if endpoint.stream:
                     response.raise_for_status()
-                    return content
-                except Exception as e:
-                    raise FailWhale(content, e)
-            caller.name = name
-            return caller
+                    streaming = True
+                    return self.messages(client, response, kwargs.get('delimited') == b'length')
+                content = response.json()
+            finally:
+                if not streaming:
+                    self.release_client(client)
+            response.raise_for_status()
+            return content
+        except FailWhale:
+            raise
+        except Exception as e:
+            raise FailWhale(content, e)
 
-        return generate_caller(method, path, obj)
+    def messages(self, client, response, delimited):
+        # the decoded messages of a stream; the client counts as busy (so it isn't
+        # closed as idle) until the stream ends or the generator is closed
+        try:
+            for message in split_messages(read_chunks(response.raw, self.STREAM_BUFFER), delimited):
+                yield self.try_json_decode(message)
+        finally:
+            response.close()
+            self.release_client(client)
 
     def try_json_decode(self, s):
         try:
@@ -188,6 +567,59 @@ class TwitterAPI:
         name = '@' + result['screen_name'].lower()
         assert self.name == name, 'Name according to self is "{0}", but "{1}" according to twitter'.format(self.name, name)
 
+CHECK_TTL = 24 * 3600                       # seconds a successful check() is trusted at startup
+CHECK_RETRY = 3600                          # seconds between checks of accounts that failed
+
+def credentials(api):
+    # fingerprint of an account's oauth configuration, to tell if a cached check still applies
+    try:
+        return hashlib.sha256(json.dumps(api.config['oauth'], sort_keys=True).encode('utf8')).hexdigest()[:16]
+    except (KeyError, TypeError):
+        return None
+
+def check_accounts(apis, state=None, on_fail=None, ttl=CHECK_TTL):
+    # check() all accounts at once and return {api: exception} for the ones that
+    # failed. Accounts that passed less than ttl seconds ago with the same
+    # credentials (as recorded in state['checks']) are trusted right away and
+    # checked again in the background, calling on_fail(api, exception) if that fails.
+    log = logging.getLogger(__name__)
+    checks = state['checks'] if state is not None else {}
+    lock = threading.Lock()
+
+    def check(api):
+        try:
+            api.check()
+        except Exception as e:
+            log.error('Check of %s failed: %s - %r', api.name, type(e).__name__, e)
+            with lock:
+                checks.pop(api.name, None)
+            return e
+        with lock:
+            checks[api.name] = {'verified': int(time.time()), 'credentials': credentials(api)}
+
+    def trusted(api):
+        entry = checks.get(api.name)
+        return bool(entry) and time.time() - entry['verified'] < ttl and entry['credentials'] == credentials(api)
+
+    def check_all(apis):
+        with concurrent.futures.ThreadPoolExecutor(max(len(apis), 1), thread_name_prefix='Check') as pool:
+            errors = { api: e for (api, e) in zip(apis, pool.map(check, apis)) if e }
+        if state is not None:
+            state.save()
+        return errors
+
+    def recheck(apis):
+        for (api, e) in check_all(apis).items():
+            if on_fail:
+                on_fail(api, e)
+
+    cached = [ api for api in apis if trusted(api) ]
+    failed = check_all([ api for api in apis if api not in cached ])
+    if cached:
+        log.info('Trusting earlier checks of %s', ', '.join(api.name for api in cached))
+        threading.Thread(name='Recheck', target=recheck, args=(cached,), daemon=True).start()
+    return failed
+
 class StreamAPI(TwitterAPI):
     API_HOST = 'stream.twitter.com'
     API_STREAM = True
@@ -0,0 +1,297 @@
+import asyncio
+import gzip
+import time
+import unittest
+import zlib
+
+import mock
+import requests
+
+from robot_zoo import aio
+from robot_zoo import pycron
+from robot_zoo import ratelimit
+from robot_zoo import twitter
+
+class TestTransport(unittest.TestCase):
+    def setUp(self):
+        self.connections = 0
+        self.responses = []
+
+    async def handle(self, reader, writer):
+        self.connections += 1
+        while (await reader.readline()):
+            length = 0
+            while (line := await reader.readline()) != b'\r\n':
+                if line.lower().startswith(b'content-length:'):
+                    length = int(line.split(b':')[1])
+            await reader.readexactly(length)
+            writer.write(self.responses.pop(0))
+            await writer.drain()
+        writer.close()
+
+    def send(self, *urls):
+        async def main():
+            server = await asyncio.start_server(self.handle, '127.0.0.1', 0)
+            port = server.sockets[0].getsockname()[1]
+            transport = aio.Transport()
+            try:
+                return [ await transport.send(requests.Request('POST', f"http://127.0.0.1:{port}{url}", data={'a': 'b'}).prepare()) for url in urls ]
+            finally:
+                transport.close()
+                server.close()
+        return asyncio.run(main())
+
+    def test_content_length(self):
+        self.responses = [ b'HTTP/1.1 200 OK\r\nContent-Length: 7\r\n\r\n{"a":1}' ]
+        (response,) = self.send('/1')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {'a': 1})
+
+    def test_chunked(self):
+        self.responses = [ b'HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n3\r\n{"a\r\n4\r\n":1}\r\n0\r\n\r\n' ]
+        (response,) = self.send('/1')
+        self.assertEqual(response.json(), {'a': 1})
+
+    def test_keep_alive(self):
+        self.responses = [ b'HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\n{}' ] * 3
+        self.send('/1', '/2', '/3')
+        self.assertEqual(self.connections, 1)
+
+    def test_connection_close(self):
+        self.responses = [ b'HTTP/1.1 404 Not Found\r\nContent-Length: 2\r\nConnection: close\r\n\r\n{}' ] * 2
+        (first, second) = self.send('/1', '/2')
+        self.assertEqual(self.connections, 2)
+        with self.assertRaises(requests.HTTPError):
+            first.raise_for_status()
+
+    def test_gzip(self):
+        body = gzip.compress(b'{"a": 1}')
+        self.responses = [ b'HTTP/1.1 200 OK\r\nContent-Encoding: gzip\r\nContent-Length: %d\r\n\r\n%s' % (len(body), body) ]
+        (response,) = self.send('/1')
+        self.assertEqual(response.json(), {'a': 1})
+
+    def stream(self, headers, chunks):
+        async def handle(reader, writer):
+            while (line := await reader.readline()) != b'\r\n':
+                self.request_headers.append(line)
+            writer.write(b'HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n' + headers + b'\r\n')
+            for chunk in chunks:
+                writer.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+                await writer.drain()
+                await asyncio.sleep(0.01)
+            writer.write(b'0\r\n\r\n')
+            writer.close()
+        async def main():
+            server = await asyncio.start_server(handle, '127.0.0.1', 0)
+            port = server.sockets[0].getsockname()[1]
+            try:
+                response = await aio.Transport().stream(requests.Request('GET', f"http://127.0.0.1:{port}/1").prepare())
+                received = []
+                while (chunk := await response.content.read1(4)):
+                    received.append(chunk)
+                return (response.status_code, received)
+            finally:
+                server.close()
+        self.request_headers = []
+        return asyncio.run(main())
+
+    def test_stream(self):
+        (status_code, chunks) = self.stream(b'', [ b'{"a":', b' 1}\r\n\r\n', b'{"b": 2}\r\n' ])
+        self.assertEqual(status_code, 200)
+        self.assertEqual(b''.join(chunks), b'{"a": 1}\r\n\r\n{"b": 2}\r\n')
+        self.assertLessEqual(max(map(len, chunks)), 4)
+
+    def test_stream_gzip(self):
+        z = zlib.compressobj(wbits=31)
+        chunks = [ z.compress(data) + z.flush(zlib.Z_SYNC_FLUSH) for data in (b'{"a": 1}\r\n', b'\r\n') ] + [ z.flush() ]
+        (_, received) = self.stream(b'Content-Encoding: gzip\r\n', chunks)
+        self.assertEqual(b''.join(received), b'{"a": 1}\r\n\r\n')
+        self.assertIn(b'Accept-Encoding: gzip, deflate\r\n', self.request_headers)
+
+class TestAsyncTwitterAPI(unittest.TestCase):
+    def setUp(self):
+        api = twitter.TwitterAPI('johndoeveloper')
+        api.config.config = {'oauth': {'consumer_key': 'key', 'consumer_secret': 'secret', 'token': 'token', 'token_secret': 'secret'}}
+        api.rate_limiter = ratelimit.RateLimiter()
+        self.transport = mock.Mock()
+        self.api = aio.AsyncTwitterAPI(api, self.transport)
+
+    def respond(self, status_code, content, headers={}):
+        async def send(request):
+            self.request = request
+            return aio.Response(status_code, '', headers, content)
+        self.transport.send = send
+
+    def test_post(self):
+        self.respond(200, b'{"id": 1}', {'x-rate-limit-limit': '15', 'x-rate-limit-remaining': '14', 'x-rate-limit-reset': '2000000000'})
+        self.assertEqual(asyncio.run(self.api.post_statuses_update(status='test')), {'id': 1})
+        self.assertEqual(self.request.url, 'https://api.twitter.com/1.1/statuses/update.json')
+        self.assertEqual(self.request.body, 'status=test')
+        self.assertEqual(self.api.api.rate_limit('post_statuses_update'), (15, 14, 2000000000))
+
+    def test_error(self):
+        self.respond(403, b'{"errors": []}')
+        with self.assertRaises(twitter.FailWhale):
+            asyncio.run(self.api.post_statuses_update(status='test'))
+
+    def test_blocking(self):
+        self.respond(200, b'{"id": 1}')
+        async def main():
+            api = aio.BlockingAPI(self.api, asyncio.get_running_loop())
+            return await asyncio.to_thread(api.post_statuses_update, status='test')
+        self.assertEqual(asyncio.run(main()), {'id': 1})
+
+    def test_blocking_rate_limited(self):
+        self.respond(200, b'{"id": 1}')
+        self.api.api.rate_limiter.update(('@johndoeveloper', '/statuses/update'), {'x-rate-limit-limit': '15', 'x-rate-limit-remaining': '0', 'x-rate-limit-reset': str(int(time.time()) + 30)})
+        def post(api):
+            twitter.worker.attempt = 1
+            try:
+                return api.post_statuses_update(status='test')
+            finally:
+                twitter.worker.attempt = None
+        async def main():
+            api = aio.BlockingAPI(self.api, asyncio.get_running_loop())
+            return await asyncio.to_thread(post, api)
+        with self.assertRaises(twitter.RateLimited) as e:
+            asyncio.run(main())
+        self.assertGreater(e.exception.wait, 20)
+
+    def respond_stream(self, chunks):
+        class Body(object):
+            closed = False
+            async def read1(self, size):
+                return chunks.pop(0) if chunks else b''
+            def close(self):
+                self.closed = True
+        async def stream(request):
+            self.request = request
+            return aio.Response(200, 'OK', {}, self.body)
+        self.body = Body()
+        self.transport.stream = stream
+        api = twitter.StreamAPI('johndoeveloper')
+        api.config.config = self.api.api.config.config
+        api.rate_limiter = ratelimit.RateLimiter()
+        return aio.AsyncTwitterAPI(api, self.transport)
+
+    def test_stream(self):
+        stream = self.respond_stream([ b'{"id": 1}\r', b'\n\r\n{"id"', b': 2}\r\n' ])
+        async def main():
+            return [ message async for message in await stream.get_statuses_filter(locations='1,2,3,4') ]
+        self.assertEqual(asyncio.run(main()), [{'id': 1}, b'', {'id': 2}])
+        self.assertTrue(self.body.closed)
+
+    def test_blocking_stream(self):
+        stream = self.respond_stream([ b'{"id": 1}\r\n\r\n', b'{"id": 2}\r\n' ])
+        async def main():
+            api = aio.BlockingAPI(stream, asyncio.get_running_loop())
+            return await asyncio.to_thread(lambda: [ *api.get_statuses_filter(locations='1,2,3,4') ])
+        self.assertEqual(asyncio.run(main()), [{'id': 1}, b'', {'id': 2}])
+        self.assertTrue(self.body.closed)
+
+class TestAsyncTaskQueue(unittest.TestCase):
+    def test_order(self):
+        async def main():
+            q = aio.AsyncTaskQueue()
+            now = time.monotonic()
+            q.put(pycron.Task(print, ('late',), deadline=now + 60))
+            q.put(pycron.Task(print, ('low',), priority=1, deadline=now + 1))
+            q.put(pycron.Task(print, ('soon',), deadline=now + 1))
+            q.put(None)
+            return [ task and task.args[0] for task in [ await q.get() for _ in range(4) ] ]
+        self.assertEqual(asyncio.run(main()), ['soon', 'late', 'low', None])
+
+    def test_stale_dropped(self):
+        async def main():
+            q = aio.AsyncTaskQueue()
+            q.put(pycron.Task(print, deadline=time.monotonic() - 1))
+            q.put(pycron.Task(print, deadline=time.monotonic() + 1), delay=5)
+            q.put(None)
+            return (await q.get(), q.dropped)
+        self.assertEqual(asyncio.run(main()), (None, {'print': 2}))
+
+    def test_waiters(self):
+        async def main():
+            q = aio.AsyncTaskQueue()
+            getters = [ asyncio.ensure_future(q.get()) for _ in range(3) ]
+            await asyncio.sleep(0)
+            for i in range(3):
+                q.put(pycron.Task(print, (i,)))
+            return sorted(task.args[0] for task in await asyncio.gather(*getters))
+        self.assertEqual(asyncio.run(main()), [0, 1, 2])
+
+    def test_serial_per_bot(self):
+        class Bot(object):
+            def tick(self, t):
+                pass
+        (foo, bar) = (Bot(), Bot())
+        async def main():
+            q = aio.AsyncTaskQueue()
+            q.put(pycron.Task(foo.tick, (1,)))
+            q.put(pycron.Task(foo.tick, (2,)))
+            q.put(pycron.Task(bar.tick, (3,)))
+            first = await q.get()
+            second = await q.get()
+            third = asyncio.ensure_future(q.get())
+            await asyncio.sleep(0.01)
+            waited = not third.done()
+            q.done(first)
+            return (first.args, second.args, waited, (await third).args)
+        self.assertEqual(asyncio.run(main()), ((1,), (3,), True, (2,)))
+
+class TestAsyncExecutor(unittest.TestCase):
+    def test_coroutine_retried(self):
+        calls = []
+        async def post():
+            calls.append(time.monotonic())
+            if len(calls) < 3:
+                raise twitter.FailWhale('error')
+        async def main():
+            executor = aio.AsyncExecutor(threads=1)
+            executor.RETRY_BASE = 0.01
+            executor.queue.put(pycron.Task(post))
+            worker = asyncio.ensure_future(executor.run(count=1))
+            while len(calls) < 3:
+                await asyncio.sleep(0.01)
+            executor.queue.put(None)
+            await worker
+            return executor.retried
+        self.assertEqual(asyncio.run(main()), 2)
+
+    def test_sync_retried(self):
+        calls = []
+        class Bot(object):
+            log = mock.Mock()
+            @twitter.retry
+            def post(self):
+                calls.append(twitter.worker.attempt)
+                if len(calls) < 2:
+                    raise twitter.FailWhale('error')
+        async def main():
+            executor = aio.AsyncExecutor(threads=1)
+            executor.RETRY_BASE = 0.01
+            executor.queue.put(pycron.Task(Bot().post))
+            worker = asyncio.ensure_future(executor.run(count=1))
+            while len(calls) < 2:
+                await asyncio.sleep(0.01)
+            executor.queue.put(None)
+            await worker
+            executor.pool.shutdown()
+        asyncio.run(main())
+        self.assertEqual(calls, [1, 2])
+
+class TestAsyncCronRunner(unittest.TestCase):
+    def test_timer_wakes_runner(self):
+        def tick(t):
+            pass
+        async def main():
+            runner = pycron.CronRunner('test', time.gmtime, aio.AsyncTaskQueue(),
+                ('00       00       00       01       01       2037     *       ', tick))
+            task = asyncio.ensure_future(aio.AsyncCronRunner(runner).run())
+            await asyncio.sleep(0.1)
+            await asyncio.to_thread(runner.at, time.time(), print)
+            try:
+                return await asyncio.wait_for(runner.queue.get(), 2)
+            finally:
+                task.cancel()
+        self.assertIs(asyncio.run(main()).action, print)
@@ -1,3 +1,6 @@
+import datetime
+import os
+import tempfile
 import time
 import unittest
 
@@ -45,19 +48,19 @@ class TestCasioF91W_OK(unittest.TestCase):
         self.api = mock.Mock()
         self.state = mock.Mock()
 
-        def get_mentions(count=200, since_id=None):
+        def get_mentions(count=200, since_id=None, max_id=None):
             if not since_id:
                 return [TestCasioF91W_OK.mentions[0]]
             else:
-                return [ m for m in TestCasioF91W_OK.mentions
-                         if int(m['id']) > int(since_id) ]
+                return [ m for m in reversed(TestCasioF91W_OK.mentions)
+                         if int(since_id) < int(m['id']) <= int(max_id or 1e9) ][:count]
 
         config = {
             'last_mention': '',
             'alarms': {}
         }
 
-        state = {'alarms': {}, 'last_mention': {}}
+        state = self.state_dict = {'last_mention': None, 'mention_cursor': None}
 
         self.api.log.return_value = None
         self.api.post_statuses_update.return_value = True
@@ -68,11 +71,17 @@ class TestCasioF91W_OK(unittest.TestCase):
         self.state.__getitem__ = lambda s, i: state.__getitem__(i)
         self.state.__setitem__ = lambda s, i, v: state.__setitem__(i, v)
 
-        self.casiof91w = casio_f91w.CasioF91W('casiof91w', self.api, self.state)
+        self.casiof91w = casio_f91w.CasioF91W('casiof91w', self.api, self.state, casio_f91w.AlarmStore(None))
 
     def _time(self, s):
         return time.strptime(s, '%Y-%m-%dT%H:%M:%SZ')
 
+    def _alarms(self):
+        alarms = {}
+        for (minute, tid, screen_name, _) in self.casiof91w.alarms.items():
+            alarms.setdefault('{0:02}:{1:02}'.format(*divmod(minute, 60)), {})[str(tid)] = screen_name
+        return alarms
+
     def test_send_beep(self):
         t = self._time('2012-07-23T20:00:00Z')
         result = self.casiof91w.send_beep(t)
@@ -83,13 +92,28 @@ class TestCasioF91W_OK(unittest.TestCase):
     def test_get_mentions(self):
         result = self.casiof91w.get_mentions()
         self.assertEqual(1, len(list(result)))
-        self.assertEqual('1', self.api.config['last_mention'])
+        self.assertEqual('1', self.state_dict['last_mention'])
         result = self.casiof91w.get_mentions()
         self.assertEqual(7, len(list(result)))
-        self.assertEqual('8', self.api.config['last_mention'])
+        self.assertEqual('8', self.state_dict['last_mention'])
         result = self.casiof91w.get_mentions()
         self.assertEqual(0, len(list(result)))
-        self.assertEqual('8', self.api.config['last_mention'])
+        self.assertEqual('8', self.state_dict['last_mention'])
+
+    def test_get_mentions_paged(self):
+        self.state_dict['last_mention'] = '1'
+        self.casiof91w.MENTIONS_PAGE = 3
+        pages = self.casiof91w.get_mention_pages()
+        self.assertEqual([ m['id'] for m in next(pages) ], ['8', '7', '6'])
+        self.assertEqual([ m['id'] for m in next(pages) ], ['5', '4', '3'])
+        self.assertEqual(self.state_dict, {'last_mention': '1', 'mention_cursor': ['5', '8']})
+        pages.close()
+        # resumes below the last page that was done with
+        casiof91w = casio_f91w.CasioF91W('casiof91w', self.api, self.state, casio_f91w.AlarmStore(None))
+        casiof91w.MENTIONS_PAGE = 3
+        self.assertEqual([ m['id'] for m in casiof91w.get_mentions() ], ['5', '4', '3', '2'])
+        self.assertEqual(self.state_dict, {'last_mention': '8', 'mention_cursor': None})
+        self.assertEqual(list(casiof91w.get_mentions()), [])
 
     def test_parse_tweet_for_alarm_1(self):
         result = self.casiof91w.parse_tweet_for_alarm(self.mentions[0])
@@ -130,20 +154,20 @@ class TestCasioF91W_OK(unittest.TestCase):
             '20:00': {
                 '2': 'test2'
             }
-        }, self.api.config['alarms'])
+        }, self._alarms())
 
     def test_handle_mentions(self):
         result = self.casiof91w.handle_mentions(self._time('2012-07-23T20:00:00Z'))
 
         self.assertTrue(result)
-        self.assertEqual(0, len(self.api.config['alarms']))
-        self.assertEqual('1', self.api.config['last_mention'])
+        self.assertEqual(0, len(self.casiof91w.alarms))
+        self.assertEqual('1', self.state_dict['last_mention'])
 
         result = self.casiof91w.handle_mentions(self._time('2012-07-23T20:00:00Z'))
 
         self.assertTrue(result)
-        self.assertEqual(3, len(self.api.config['alarms']))
-        self.assertEqual('8', self.api.config['last_mention'])
+        self.assertEqual(7, len(self.casiof91w.alarms))
+        self.assertEqual('8', self.state_dict['last_mention'])
 
         self.assertEqual({
             '00:00': {
@@ -159,9 +183,9 @@ class TestCasioF91W_OK(unittest.TestCase):
                 '5': 'test5',
                 '6': 'test6'
             }
-        }, self.api.config['alarms'])
+        }, self._alarms())
 
-        self.assertTrue(self.api.save.called)
+        self.assertTrue(self.state.save.called)
 
     def test_send_alarms(self):
         self.casiof91w.handle_mentions(self._time('2012-07-23T20:00:00Z'))
@@ -172,27 +196,25 @@ class TestCasioF91W_OK(unittest.TestCase):
         self.assertTrue(result)
 
         self.api.post_statuses_update.assert_any_call(
-            in_reply_to_status_id='2',
+            in_reply_to_status_id=2,
             status='@test2 BEEP BEEP! BEEP BEEP! BEEP BEEP! BEEP BEEP! BEEP BEEP! BEEP BEEP! BEEP BEEP! BEEP BEEP! BEEP BEEP! BEEP BEEP! BEEP BEEP! BEEP BEEP!')
 
         self.api.post_statuses_update.assert_any_call(
-            in_reply_to_status_id='3',
+            in_reply_to_status_id=3,
             status='@test3 BEEP BEEP! BEEP BEEP! BEEP BEEP! BEEP BEEP! BEEP BEEP! BEEP BEEP! BEEP BEEP! BEEP BEEP! BEEP BEEP! BEEP BEEP! BEEP BEEP! BEEP BEEP!')
 
         self.api.post_statuses_update.assert_any_call(
-            in_reply_to_status_id='4',
+            in_reply_to_status_id=4,
             status='@test4 BEEP BEEP! BEEP BEEP! BEEP BEEP! BEEP BEEP! BEEP BEEP! BEEP BEEP! BEEP BEEP! BEEP BEEP! BEEP BEEP! BEEP BEEP! BEEP BEEP! BEEP BEEP!')
 
         self.api.post_statuses_update.assert_any_call(
-            in_reply_to_status_id='5',
+            in_reply_to_status_id=5,
             status='@test5 BEEP BEEP! BEEP BEEP! BEEP BEEP! BEEP BEEP! BEEP BEEP! BEEP BEEP! BEEP BEEP! BEEP BEEP! BEEP BEEP! BEEP BEEP! BEEP BEEP! BEEP BEEP!')
 
         self.api.post_statuses_update.assert_any_call(
-            in_reply_to_status_id='6',
+            in_reply_to_status_id=6,
             status='@test6 BEEP BEEP! BEEP BEEP! BEEP BEEP! BEEP BEEP! BEEP BEEP! BEEP BEEP! BEEP BEEP! BEEP BEEP! BEEP BEEP! BEEP BEEP! BEEP BEEP! BEEP BEEP!')
 
-        self.api.save.assert_any_call()
-
         self.assertEqual({
             '00:00': {
                 '8': 'test8'
@@ -200,7 +222,7 @@ class TestCasioF91W_OK(unittest.TestCase):
             '07:00': {
                 '7': 'test7'
             }
-        }, self.api.config['alarms'])
+        }, self._alarms())
 
     def test_send_no_alarms(self):
         self.casiof91w.handle_mentions(self._time('2012-07-23T18:00:00Z'))
@@ -211,6 +233,133 @@ class TestCasioF91W_OK(unittest.TestCase):
         self.assertTrue(result)
         self.assertTrue(not self.api.post_statuses_update.called)
 
+class TestCasioF91W_Alarms(unittest.TestCase):
+    def setUp(self):
+        self.api = mock.Mock()
+        self.state = mock.MagicMock()
+        self.state.__getitem__.side_effect = {'last_mention': None}.__getitem__
+        self.alarms = casio_f91w.AlarmStore(None)
+        for i in range(10):
+            self.alarms.add(7, 0, i, f"test{i}")
+        self.alarms.add(8, 0, 99, 'test99')
+        self.casiof91w = casio_f91w.CasioF91W('casiof91w', self.api, self.state, self.alarms)
+        self.t = time.strptime('2012-07-24T07:00:00Z', '%Y-%m-%dT%H:%M:%SZ')
+
+    def _sent(self):
+        return sorted(c[1]['in_reply_to_status_id'] for c in self.api.post_statuses_update.call_args_list)
+
+    def test_all_sent(self):
+        self.assertTrue(self.casiof91w.send_alarms(self.t))
+        self.assertEqual(self._sent(), [*range(10)])
+        self.assertEqual([ tid for (_, tid, _, _) in self.alarms.items() ], [99])
+
+    def test_only_failed_resent(self):
+        def post(status, in_reply_to_status_id):
+            if in_reply_to_status_id in (3, 5) and self.api.post_statuses_update.call_count <= 10:
+                raise twitter.FailWhale('down')
+        self.api.post_statuses_update.side_effect = post
+        with mock.patch('time.sleep'):
+            self.assertTrue(self.casiof91w.send_alarms(self.t))
+        self.assertEqual(self.api.post_statuses_update.call_count, 12)
+        self.assertEqual([ tid for tid in self._sent() if self._sent().count(tid) > 1 ], [3, 3, 5, 5])
+        self.assertEqual(len(self.alarms), 1)
+
+    def test_concurrent(self):
+        def post(status, in_reply_to_status_id):
+            time.sleep(0.02)
+        self.api.post_statuses_update.side_effect = post
+        started = time.monotonic()
+        self.casiof91w.send_alarms(self.t)
+        self.assertLess(time.monotonic() - started, 0.02 * 10 / 2)
+
+    def test_expired_not_sent(self):
+        self.alarms.add(7, 0, 100, 'old', now=time.time() - (self.alarms.TTL + 1) * 86400)
+        self.casiof91w.send_alarms(self.t)
+        self.assertNotIn(100, self._sent())
+        self.assertEqual(len(self.alarms), 1)
+
+    def test_migrate(self):
+        state = mock.MagicMock()
+        state.__getitem__.side_effect = {'alarms': {'07:00': {'1': 'test1'}}, 'last_mention': None}.__getitem__
+        casiof91w = casio_f91w.CasioF91W('casiof91w', self.api, state, casio_f91w.AlarmStore(None))
+        self.assertEqual([ (m, tid, sn) for (m, tid, sn, _) in casiof91w.alarms.items() ], [(420, 1, 'test1')])
+        state.__setitem__.assert_called_with('alarms', {})
+        self.assertTrue(state.save.called)
+
+class TestCasioF91W_Parse(unittest.TestCase):
+    def setUp(self):
+        self.casiof91w = casio_f91w.CasioF91W('casiof91w', mock.Mock(), mock.MagicMock(), casio_f91w.AlarmStore(None))
+
+    def _tweet(self, text):
+        return {'id': '1', 'user': {'screen_name': 'test1'}, 'text': text}
+
+    def _alarm(self, text, today=datetime.date(2012, 1, 1)):
+        return self.casiof91w.parse_tweet_for_alarm(self._tweet(text), today)[0]
+
+    def test_forms(self):
+        self.assertEqual(self._alarm('alarm 20:00 +0100'), (20, 0))
+        self.assertEqual(self._alarm('alarm 08:00 PM +0100'), (20, 0))
+        self.assertEqual(self._alarm('alarm 03:00 PM -0400'), (20, 0))
+        self.assertEqual(self._alarm('alarm 20:00 +0100', datetime.date(2012, 7, 1)), (21, 0))
+        self.assertEqual(self._alarm('alarm 12:00 AM'), (0, 0))
+        self.assertEqual(self._alarm('alarm 13:00 PM'), (13, 0))
+        self.assertEqual(self._alarm('alarm 7:05'), (7, 5))
+        self.assertEqual(self._alarm('alarm 25:00'), None)
+
+    def test_precedence(self):
+        self.assertEqual(self._alarm('alarm 7:00 and alarm 09:00 PM'), (21, 0))
+        self.assertEqual(self._alarm('alarm 07:00 PM and alarm 18:00 +0000'), (19, 0))
+
+    def test_parse_mentions(self):
+        mentions = [ self._tweet('alarm 7:00'), self._tweet('hello'), self._tweet('alarm 08:00 PM +0100') ]
+        self.assertEqual([ alarm for (alarm, _) in self.casiof91w.parse_mentions(mentions) ],
+                         [ self.casiof91w.parse_tweet_for_alarm(m)[0] for m in mentions ])
+
+class TestAlarmStore(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'casio_f91w.alarms')
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_journal(self):
+        store = casio_f91w.AlarmStore(self.path)
+        store.add(7, 0, 1, 'test1')
+        store.add(7, 0, 2, 'test2')
+        store.save()
+        store.remove(7, 0, [1])
+        store.add(8, 30, 3, 'test2')
+        store.save()
+        with open(self.path) as f:
+            self.assertEqual(len(f.readlines()), 4)
+        loaded = casio_f91w.AlarmStore(self.path)
+        self.assertEqual(loaded.due(7, 0), [(2, 'test2')])
+        self.assertEqual(loaded.due(8, 30), [(3, 'test2')])
+        self.assertIs(loaded.due(7, 0)[0][1], loaded.due(8, 30)[0][1])
+
+    def test_torn_line(self):
+        with open(self.path, 'w') as f:
+            f.write('+ 420 1 test1 20744\n+ 421 99\n+ 999999 2 test2 20744\n+ 421 3 test3 20744\n+ 421 99')
+        store = casio_f91w.AlarmStore(self.path)
+        self.assertEqual([ tid for (_, tid, _, _) in store.items() ], [1, 3])
+        store.add(8, 0, 4, 'test4')
+        store.save()
+        self.assertEqual([ tid for (_, tid, _, _) in casio_f91w.AlarmStore(self.path).items() ], [1, 3, 4])
+
+    def test_compact(self):
+        store = casio_f91w.AlarmStore(self.path)
+        store.COMPACT_MIN = 10
+        store.add(7, 0, 99, 'test', now=0)
+        store.add(7, 1, 100, 'test')
+        for i in range(20):
+            store.add(7, 0, i, 'test')
+            store.remove(7, 0, [i])
+            store.save()
+        with open(self.path) as f:
+            self.assertLess(len(f.readlines()), 20)
+        self.assertEqual([ tid for (_, tid, _, _) in casio_f91w.AlarmStore(self.path).items() ], [100])
+
 class TestCasioF91W_Fail(unittest.TestCase):
     def setUp(self):
         config = {
@@ -225,7 +374,10 @@ class TestCasioF91W_Fail(unittest.TestCase):
         self.api.post_statuses_update.side_effect = twitter.FailWhale
         self.api.get_statuses_mentions_timeline.side_effect = twitter.FailWhale
         self.api.config.__getitem__ = lambda s, i: config.__getitem__(i)
-        self.casiof91w = casio_f91w.CasioF91W('casiof91w', self.api)
+        state = mock.MagicMock()
+        state.__getitem__.side_effect = {'last_mention': None, 'mention_cursor': None}.__getitem__
+        self.casiof91w = casio_f91w.CasioF91W('casiof91w', self.api, state, casio_f91w.AlarmStore(None))
+        self.casiof91w.alarms.add(20, 0, 42, 'j0057m')
 
     def _time(self, s):
         return time.strptime(s, '%Y-%m-%dT%H:%M:%SZ')
@@ -1,3 +1,4 @@
+import datetime
 import unittest
 
 from robot_zoo import holidays
@@ -69,3 +70,24 @@ class TestHolidayNone(unittest.TestCase):
     def test_set_year(self):
         self.nl.year = 2014
         assert self.nl(6, 9) == "Tweede Pinksterdag"
+
+class TestHolidayTables(unittest.TestCase):
+    def test_shared(self):
+        holidays.NL.table(2013)
+        hits = holidays.NL.table.cache_info().hits
+        nl = holidays.NL(2013)
+        assert nl(3, 31) == "Eerste Paasdag"
+        assert holidays.NL(2013)(4, 30) == "Koninginnedag"
+        assert holidays.NL.table.cache_info().hits == hits + 2
+
+    def test_between(self):
+        result = holidays.NL.between(datetime.date(2013, 12, 25), datetime.date(2014, 4, 21))
+        assert result == [ (datetime.date(2013, 12, 25), "Eerste Kerstdag"),
+                           (datetime.date(2013, 12, 26), "Tweede Kerstdag"),
+                           (datetime.date(2014, 1, 1), "Nieuwjaarsdag"),
+                           (datetime.date(2014, 4, 20), "Eerste Paasdag") ]
+
+    def test_between_range(self):
+        result = holidays.NL.between(datetime.date(1949, 1, 1), datetime.date(2101, 1, 1))
+        assert len(result) == 152 * 11 - 8         # some years two holidays fall on one day
+        assert [ name for (date, name) in result if date.year == 1949 ].count("Koninginnedag") == 1
@@ -0,0 +1,35 @@
+import os
+import subprocess
+import sys
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# microseconds `import robot_zoo.__main__` may take, best of RUNS
+BUDGET = int(os.environ.get('ROBOT_ZOO_IMPORT_BUDGET', 150000))
+RUNS = 3
+DEFERRED = ['requests', 'ephem', 'pytz', 'dateutil', 'prctl', 'robot_zoo.bot.casio_f91w', 'robot_zoo.bot.maanfase']
+
+def importtime(module):
+    # {module: (self, cumulative)} in microseconds, as reported by -X importtime
+    result = subprocess.run([ sys.executable, '-X', 'importtime', '-c', f"import {module}" ],
+                            cwd=ROOT, capture_output=True, text=True, check=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        (own, cumulative, name) = line[len('import time:'):].split('|')
+        times[name.strip()] = (int(own), int(cumulative))
+    return times
+
+class TestImportTime(unittest.TestCase):
+    def test_deferred(self):
+        times = importtime('robot_zoo.__main__')
+        self.assertEqual([ name for name in DEFERRED if name in times ], [])
+
+    def test_budget(self):
+        runs = [ importtime('robot_zoo.__main__') for _ in range(RUNS) ]
+        times = min(runs, key=lambda times: times['robot_zoo.__main__'][1])
+        slowest = sorted(times.items(), key=lambda item: -item[1][0])[:10]
+        report = '\n'.join(f"{own:9} {cumulative:9}  {name}" for (name, (own, cumulative)) in slowest)
+        self.assertLessEqual(times['robot_zoo.__main__'][1], BUDGET, f"import robot_zoo.__main__ over budget; slowest modules (self, cumulative us):\n{report}")
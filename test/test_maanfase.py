@@ -1,3 +1,5 @@
+import os
+import tempfile
 import time
 import unittest
 
@@ -27,10 +29,71 @@ class TestMaanfaseModel(unittest.TestCase):
 
         self.assertEqual(result, None)
 
+class TestPhaseCache(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.cache = maanfase.PhaseCache(os.path.join(self.dir.name, 'maanfase.phases'))
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_missing(self):
+        self.assertIsNone(self.cache.get(2013))
+        self.cache.put(2014, [(1, 1, 12, 14, 0, 3)])
+        self.assertIsNone(self.cache.get(2013))
+        self.assertIsNone(self.cache.get(2015))
+
+    def test_cached_model(self):
+        self.assertEqual(maanfase.MoonModel(2013, self.cache)._phases, maanfase.MoonModel(2013)._phases)
+        self.assertEqual(os.path.getsize(self.cache.path), (2014 - self.cache.FIRST_YEAR) * self.cache.BLOCK)
+        with mock.patch.object(maanfase.MoonModel, '_compute') as compute:
+            model = maanfase.MoonModel(2013, maanfase.PhaseCache(self.cache.path))
+            self.assertFalse(compute.called)
+        self.assertEqual(model[2013, 12, 17, 10, 28], (10, 28, 5, 2))
+
+    def test_read_only(self):
+        with mock.patch('robot_zoo.twitter.READ_ONLY', True):
+            self.assertEqual(len(maanfase.MoonModel(2013, self.cache)._phases), 49)
+        self.assertFalse(os.path.exists(self.cache.path))
+
+    def test_warm_up(self):
+        bot = maanfase.Maanfase('maanfase', mock.Mock(), self.cache)
+        bot.warm_up(time.strptime('2013-12-17T03:00:30Z', '%Y-%m-%dT%H:%M:%SZ'))
+        self.assertEqual([ len(self.cache.get(year) or []) for year in (2013, 2014, 2015) ], [49, 50, 0])
+        with mock.patch.object(maanfase.MoonModel, '_compute') as compute:
+            bot.post_phase(time.strptime('2014-01-01T00:00:00Z', '%Y-%m-%dT%H:%M:%SZ'))
+            self.assertFalse(compute.called)
+
+class TestMaanfaseSchedule(unittest.TestCase):
+    def test_schedule(self):
+        with tempfile.TemporaryDirectory() as d:
+            bot = maanfase.Maanfase('maanfase', mock.Mock(), maanfase.PhaseCache(os.path.join(d, 'maanfase.phases')))
+            runner = mock.Mock()
+            with mock.patch('time.time', return_value=maanfase.TZ_CET.localize(maanfase.datetime(2013, 12, 1)).timestamp()):
+                bot.schedule(time.struct_time((2013, 12, 1, 0, 0, 0, 6, 335, 0)), runner)
+        calls = runner.at.call_args_list
+        self.assertEqual([ c[0][1] for c in calls ], [bot.post_phase] * 4 + [bot.schedule])
+        self.assertEqual(calls[2][0][0], maanfase.TZ_CET.localize(maanfase.datetime(2013, 12, 17, 10, 28, 5)).timestamp())
+        self.assertEqual(calls[4][0], (maanfase.TZ_CET.localize(maanfase.datetime(2014, 1, 1)).timestamp(), bot.schedule, runner))
+
+    def test_add_timers(self):
+        with tempfile.TemporaryDirectory() as d:
+            bot = maanfase.Maanfase('maanfase', mock.Mock(), maanfase.PhaseCache(os.path.join(d, 'maanfase.phases')))
+            runner = mock.Mock()
+            bot.add_timers(2014, runner)
+        calls = runner.at.call_args_list
+        self.assertEqual(len(calls), 50)
+        self.assertEqual({ c[0][1] for c in calls }, {bot.post_phase})
+        self.assertIn('schedule', bot.HOUSEKEEPING)
+
 class TestMaanfase(unittest.TestCase):
     def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
         self.api = mock.Mock()
-        self.maanfase = maanfase.Maanfase('maanfase', self.api)
+        self.maanfase = maanfase.Maanfase('maanfase', self.api, maanfase.PhaseCache(os.path.join(self.dir.name, 'maanfase.phases')))
+
+    def tearDown(self):
+        self.dir.cleanup()
 
     def _time(self, s):
         return time.strptime(s, '%Y-%m-%dT%H:%M:%SZ')
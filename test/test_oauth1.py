@@ -1,4 +1,5 @@
 import unittest
+import urllib.parse
 
 import mock
 
@@ -116,3 +117,19 @@ class TestOauth1(unittest.TestCase):
     def test_nonce(self):
         result = oauth1.nonce()
         self.assertNotEqual(result, '')
+
+    def test_nonce_pool(self):
+        nonces = { oauth1.nonce() for _ in range(1000) }
+        self.assertEqual(len(nonces), 1000)
+        self.assertEqual({ len(n) for n in nonces }, {48})
+
+    def test_urlencode(self):
+        for s in [ '', 'abc-_.~', 'a b+c&d=e%f/g', 'Ladies ― \U0001f600', b'\xe2\x80\x95\x00\xff' ]:
+            self.assertEqual(oauth1.urlencode(s), urllib.parse.quote(s, safe=''))
+
+    def test_credentials_changed(self):
+        self.oauth1._authorization(self.method, self.url, self.get, self.post)
+        self.oauth1.token_secret = 'other'
+        sig_key = self.oauth1._get_sig_key()
+        self.assertEqual(sig_key, 'kAcSOqF21Fu85e7zjz7ZN2U4ZRhfV3WpwPAoE3Z7kBw&other')
+        self.assertEqual(self.oauth1._calc_sig(sig_key, 'test'), oauth1.hmac_sha1(sig_key, 'test'))
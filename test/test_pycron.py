@@ -0,0 +1,453 @@
+import calendar
+import datetime
+import queue
+import threading
+import time
+import unittest
+
+import mock
+
+from robot_zoo import pycron
+from robot_zoo import twitter
+
+class Bot(object):
+    def __init__(self, name):
+        self.name = name
+
+    def tick(self, t):
+        pass
+
+    def tock(self, t):
+        pass
+
+class TestCronRunner(unittest.TestCase):
+    def setUp(self):
+        self.foo = Bot('foo')
+        self.bar = Bot('bar')
+        self.runner = pycron.CronRunner('test', time.gmtime, mock.Mock(),
+            ('*        00       12       01-07    *        *        mon     ', self.foo.tick),
+            ('*        00-59/30 *        *        *        *        *       ', self.foo.tock),
+            ('07-59/13 13       03       19       01       2038     *       ', self.bar.tick),
+            ('00       *        *        *        jan      2013-2036 *      ', self.bar.tock))
+
+    def _time(self, s):
+        return time.strptime(s, '%Y-%m-%dT%H:%M:%SZ')
+
+    def _actions(self, s):
+        return list(self.runner.get_runnable_actions(self._time(s)))
+
+    def test_parse_rule_masks(self):
+        masks, action = self.runner.rules[2]
+        self.assertEqual(action, self.bar.tick)
+        self.assertEqual(list(pycron.bits(masks[0])), [7, 20, 33, 46, 59])
+        self.assertEqual(list(pycron.bits(masks[5])), [2038])
+
+    def test_parse_rule_leading_star_is_first(self):
+        masks, _ = self.runner.rules[0]
+        self.assertEqual(list(pycron.bits(masks[0])), [0])
+
+    def test_parse_rule_names(self):
+        masks, _ = self.runner.rules[0]
+        self.assertEqual(list(pycron.bits(masks[6])), [0])
+        masks, _ = self.runner.rules[3]
+        self.assertEqual(list(pycron.bits(masks[4])), [1])
+
+    def test_no_match(self):
+        self.assertEqual(self._actions('2014-07-01T12:15:00Z'), [])
+
+    def test_match(self):
+        self.assertEqual(self._actions('2014-07-01T12:30:00Z'), [self.foo.tock])
+
+    def test_first_rule_per_owner_wins(self):
+        self.assertEqual(self._actions('2014-07-07T12:00:00Z'), [self.foo.tick])
+
+    def test_step(self):
+        self.assertEqual(self._actions('2038-01-19T03:13:20Z'), [self.bar.tick])
+        self.assertEqual(self._actions('2038-01-19T03:13:21Z'), [])
+
+    def test_owners_in_rule_order(self):
+        self.assertEqual(self._actions('2014-01-06T12:00:00Z'), [self.foo.tick, self.bar.tock])
+
+    def test_year_out_of_range(self):
+        self.assertEqual(self._actions('2037-01-06T12:01:00Z'), [])
+
+    def test_deadlines(self):
+        self.assertEqual(self.runner.deadlines, [60, 60, 1, 60])
+
+    def test_disable(self):
+        self.runner.disable(self.foo)
+        self.assertEqual(self._actions('2014-01-06T12:00:00Z'), [self.bar.tock])
+        self.runner.enable(self.foo)
+        self.assertEqual(self._actions('2014-01-06T12:00:00Z'), [self.foo.tick, self.bar.tock])
+
+    def test_bot_deadline(self):
+        self.foo.TASK_DEADLINE = 300
+        self.foo.TASK_PRIORITY = -1
+        runner = pycron.CronRunner('test', time.gmtime, mock.Mock(),
+            ('*        00       12       01-07    *        *        mon     ', self.foo.tick))
+        self.assertEqual((runner.deadlines, runner.priorities), ([300], [-1]))
+
+class TestNextFire(unittest.TestCase):
+    def setUp(self):
+        self.foo = Bot('foo')
+        self.bar = Bot('bar')
+        self.runner = pycron.CronRunner('test', time.gmtime, mock.Mock(),
+            ('*        00       *        *        *        *        *       ', self.foo.tick),
+            ('07-59    13       03       19       01       2038     *       ', self.bar.tick),
+            ('00-06    14       03       19       01       2038     *       ', self.bar.tick))
+
+    def _epoch(self, s):
+        return calendar.timegm(time.strptime(s, '%Y-%m-%dT%H:%M:%SZ'))
+
+    def _next(self, s):
+        return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(self.runner.next_fire(self._epoch(s))))
+
+    def test_next_hour(self):
+        self.assertEqual(self._next('2014-07-01T12:00:01Z'), '2014-07-01T13:00:00Z')
+
+    def test_now(self):
+        self.assertEqual(self._next('2014-07-01T12:00:00Z'), '2014-07-01T12:00:00Z')
+
+    def test_year_end(self):
+        self.assertEqual(self._next('2014-12-31T23:59:59Z'), '2015-01-01T00:00:00Z')
+
+    def test_every_second(self):
+        self.assertEqual(self._next('2038-01-19T03:13:01Z'), '2038-01-19T03:13:07Z')
+        self.assertEqual(self._next('2038-01-19T03:13:59Z'), '2038-01-19T03:13:59Z')
+        self.assertEqual(self._next('2038-01-19T03:14:03Z'), '2038-01-19T03:14:03Z')
+
+    def test_none(self):
+        runner = pycron.CronRunner('test', time.gmtime, mock.Mock(),
+            ('*        00       *        *        *        2013     *       ', self.foo.tick))
+        self.assertEqual(runner.next_fire(self._epoch('2014-01-01T00:00:00Z')), None)
+
+    def test_weekday(self):
+        runner = pycron.CronRunner('test', time.gmtime, mock.Mock(),
+            ('*        00       12       01-07    *        *        mon     ', self.foo.tick))
+        self.assertEqual(time.gmtime(runner.next_fire(self._epoch('2014-07-08T00:00:00Z')))[:3], (2014, 8, 4))
+
+class TestLifetime(unittest.TestCase):
+    def setUp(self):
+        self.foo = Bot('foo')
+        self.bar = Bot('bar')
+        self.runner = pycron.CronRunner('test', time.gmtime, mock.Mock(),
+            ('*        00-59/30 09-23    13       aug      2011     *       ', self.foo.tick),
+            ('*        00       *        *        *        *        *       ', self.foo.tock),
+            ('07       14       03       19       01-11    2037      *       ', self.bar.tick),
+            ('*        *        *        31       feb      *        *       ', self.bar.tock))
+
+    def _time(self, s):
+        return time.strptime(s, '%Y-%m-%dT%H:%M:%SZ')
+
+    def test_spans(self):
+        self.assertEqual(self.runner.spans[0], ((2011, 8, 13, 9, 0, 0), (2011, 8, 13, 23, 30, 0)))
+        self.assertEqual(self.runner.spans[2], ((2037, 1, 19, 3, 14, 7), (2037, 11, 19, 3, 14, 7)))
+        self.assertIsNone(self.runner.spans[3])
+
+    def test_live(self):
+        self.runner.get_matching_rules(self._time('2014-07-01T12:00:00Z'))
+        self.assertEqual((self.runner.live, self.runner.remaining, self.runner.active()), ([1], [1, 2], 1))
+        self.runner.get_matching_rules(self._time('2037-01-19T03:14:07Z'))
+        self.assertEqual(self.runner.live, [1, 2])
+        self.runner.get_matching_rules(self._time('2037-11-19T03:14:08Z'))
+        self.assertEqual(self.runner.live, [1])
+
+    def test_dead_rules_not_indexed(self):
+        self.assertEqual(list(self.runner.get_runnable_actions(self._time('2011-08-13T09:00:00Z'))), [self.foo.tick])
+        self.assertEqual(list(self.runner.get_runnable_actions(self._time('2014-08-13T09:00:00Z'))), [self.foo.tock])
+        self.assertEqual(self.runner.index[5], {year: 2 for year in range(2000, 2100)})
+
+    def test_pending_rule_fires(self):
+        due = self.runner.next_fire(calendar.timegm((2036, 12, 31, 23, 59, 59)))
+        self.assertEqual(due, calendar.timegm((2037, 1, 1, 0, 0, 0)))
+        due = self.runner.next_fire(calendar.timegm((2037, 1, 19, 3, 1, 0)))
+        self.assertEqual(list(self.runner.get_runnable_actions(time.gmtime(due))), [self.bar.tick])
+
+class TestRun(unittest.TestCase):
+    def test_cancel_while_sleeping(self):
+        foo = Bot('foo')
+        runner = pycron.CronRunner('test', time.gmtime, queue.Queue(),
+            ('00       00       00       01       01       2037     *       ', foo.tick))
+        cancel = runner.run()
+        cancel()
+        self.assertEqual(runner.queue.get(timeout=1), None)
+
+    def test_shutdown(self):
+        foo = Bot('foo')
+        before = set(threading.enumerate())
+        executor = pycron.CronExecutor()
+        runner = pycron.CronRunner('test', time.gmtime, executor.queue,
+            ('00       00       00       01       01       2037     *       ', foo.tick))
+        with mock.patch.object(pycron.CronRunner.run, 'i', 0):    # Runner-0 stops the executor
+            cancel = [ runner.run(), executor.run(count=2) ]
+        threads = set(threading.enumerate()) - before
+        self.assertEqual(len(threads), 3)
+        for c in cancel:
+            c()
+        for thread in threads:
+            thread.join(10)
+        self.assertEqual([ thread.name for thread in threads if thread.is_alive() ], [])
+
+class TestTimers(unittest.TestCase):
+    def setUp(self):
+        self.foo = Bot('foo')
+        self.bar = Bot('bar')
+        self.runner = pycron.CronRunner('test', time.gmtime, mock.Mock(),
+            ('*        00       *        *        *        *        *       ', self.foo.tick))
+
+    def _epoch(self, s):
+        return calendar.timegm(time.strptime(s, '%Y-%m-%dT%H:%M:%SZ'))
+
+    def _fired(self, now):
+        due = self.runner.next_fire(now)
+        self.runner.queue.reset_mock()
+        self.runner.fire(due, 0)
+        return (due, [ (task.action, task.args[1:]) for ((task,), _) in self.runner.queue.put.call_args_list ])
+
+    def test_merged_with_rules(self):
+        self.runner.at(self._epoch('2026-11-05T14:19:37Z'), self.bar.tock, 'full')
+        self.runner.at(self._epoch('2026-11-05T14:19:36Z') + 0.5, self.bar.tick)
+        self.assertEqual(self._fired(self._epoch('2026-11-05T14:00:01Z')), (self._epoch('2026-11-05T14:19:37Z'), [(self.bar.tock, ['full']), (self.bar.tick, [])]))
+        self.assertEqual(self._fired(self._epoch('2026-11-05T14:19:38Z')), (self._epoch('2026-11-05T15:00:00Z'), [(self.foo.tick, [])]))
+
+    def test_cancel(self):
+        self.runner.at(self._epoch('2026-11-05T14:19:37Z'), self.bar.tick).cancel()
+        self.assertEqual(self.runner.next_fire(self._epoch('2026-11-05T14:00:01Z')), self._epoch('2026-11-05T15:00:00Z'))
+
+    def test_missed_fires_now(self):
+        self.runner.at(self._epoch('2026-11-05T14:19:37Z'), self.bar.tick)
+        self.assertEqual(self._fired(self._epoch('2026-11-05T14:20:00Z')), (self._epoch('2026-11-05T14:20:00Z'), [(self.bar.tick, [])]))
+
+    def test_disabled_dropped(self):
+        self.runner.at(self._epoch('2026-11-05T14:19:37Z'), self.bar.tick)
+        self.runner.disable(self.bar)
+        self.assertEqual(self._fired(self._epoch('2026-11-05T14:00:01Z'))[1], [])
+        self.assertEqual(self.runner.timers, [])
+
+    def test_housekeeping_kept(self):
+        self.bar.HOUSEKEEPING = ('tock',)
+        self.runner.at(self._epoch('2026-11-05T14:19:37Z'), self.bar.tick)
+        self.runner.at(self._epoch('2026-11-05T14:19:37Z'), self.bar.tock)
+        self.runner.disable(self.bar)
+        self.assertEqual(self._fired(self._epoch('2026-11-05T14:00:01Z'))[1], [(self.bar.tock, [])])
+        self.assertIsNone(self.runner.queue.put.call_args[0][0].deadline)
+
+    def test_upcoming(self):
+        self.runner.at(self._epoch('2026-11-05T14:19:37Z'), self.bar.tick)
+        firings = list(self.runner.upcoming(datetime.datetime(2026, 11, 5, 14), datetime.datetime(2026, 11, 5, 16)))
+        self.assertEqual([ (dt.strftime('%H:%M:%S'), action) for (dt, _, action) in firings ],
+                         [('14:00:00', self.foo.tick), ('14:19:37', self.bar.tick), ('15:00:00', self.foo.tick)])
+
+    def test_wakes_runner(self):
+        runner = pycron.CronRunner('test', time.gmtime, queue.Queue(),
+            ('00       00       00       01       01       2037     *       ', self.foo.tick))
+        cancel = runner.run()
+        try:
+            time.sleep(0.1)
+            runner.at(time.time(), self.bar.tick)
+            task = runner.queue.get(timeout=2)
+        finally:
+            cancel()
+        self.assertEqual(task.action, self.bar.tick)
+
+class TestUpcoming(unittest.TestCase):
+    def setUp(self):
+        self.foo = Bot('foo')
+        self.bar = Bot('bar')
+        self.runner = pycron.CronRunner('test', time.gmtime, mock.Mock(),
+            ('*        00       12       01-07    *        *        mon     ', self.foo.tick),
+            ('*        00-59/30 *        *        *        *        *       ', self.foo.tock),
+            ('58-59    59       23       31       12       2037     *       ', self.bar.tick),
+            ('00       00       00       01       01       2038     *       ', self.bar.tock))
+
+    def test_window(self):
+        result = list(self.runner.upcoming(datetime.datetime(2014, 7, 7, 11, 15), datetime.datetime(2014, 7, 7, 13, 0)))
+        self.assertEqual(result, [
+            (datetime.datetime(2014, 7, 7, 11, 30), self.foo, self.foo.tock),
+            (datetime.datetime(2014, 7, 7, 12,  0), self.foo, self.foo.tick),
+            (datetime.datetime(2014, 7, 7, 12, 30), self.foo, self.foo.tock)])
+
+    def test_across_midnight(self):
+        result = list(self.runner.upcoming(datetime.datetime(2037, 12, 31, 23, 59, 58), datetime.datetime(2038, 1, 1, 0, 0, 1)))
+        self.assertEqual(result, [
+            (datetime.datetime(2037, 12, 31, 23, 59, 58), self.bar, self.bar.tick),
+            (datetime.datetime(2037, 12, 31, 23, 59, 59), self.bar, self.bar.tick),
+            (datetime.datetime(2038, 1, 1, 0, 0, 0), self.foo, self.foo.tock),
+            (datetime.datetime(2038, 1, 1, 0, 0, 0), self.bar, self.bar.tock)])
+
+    def test_end_is_exclusive(self):
+        result = list(self.runner.upcoming(datetime.datetime(2014, 7, 7, 11, 0), datetime.datetime(2014, 7, 7, 11, 30)))
+        self.assertEqual(result, [(datetime.datetime(2014, 7, 7, 11, 0), self.foo, self.foo.tock)])
+
+    def test_matches_runnable_actions(self):
+        start = calendar.timegm((2014, 7, 7, 11, 0, 0))
+        expected = [ (datetime.datetime(*time.gmtime(t)[:6]), action)
+                     for t in range(start, start + 7200)
+                     for action in self.runner.get_runnable_actions(time.gmtime(t)) ]
+        result = [ (dt, action) for (dt, _, action) in self.runner.upcoming(datetime.datetime(2014, 7, 7, 11), datetime.datetime(2014, 7, 7, 13)) ]
+        self.assertEqual(result, expected)
+
+class TestTaskQueue(unittest.TestCase):
+    def setUp(self):
+        self.queue = pycron.TaskQueue()
+        self.foo = Bot('foo')
+
+    def _names(self, n):
+        return [ self.queue.get().args[0] for _ in range(n) ]
+
+    def test_fifo(self):
+        self.queue.put(pycron.Task(self.foo.tick, [1]))
+        self.queue.put(pycron.Task(self.foo.tick, [2]))
+        self.assertEqual(self._names(2), [1, 2])
+
+    def test_delay(self):
+        self.queue.put(pycron.Task(self.foo.tick, ['later']), delay=0.05)
+        self.queue.put(pycron.Task(self.foo.tick, ['now']))
+        started = time.monotonic()
+        self.assertEqual(self._names(2), ['now', 'later'])
+        self.assertGreaterEqual(time.monotonic() - started, 0.05)
+        self.assertEqual(self.queue.qsize(), 0)
+
+    def test_earliest_deadline_first(self):
+        now = time.monotonic()
+        self.queue.put(pycron.Task(self.foo.tick, ['minute'], deadline=now + 60))
+        self.queue.put(pycron.Task(self.foo.tick, ['none']))
+        self.queue.put(pycron.Task(self.foo.tick, ['second'], deadline=now + 1))
+        self.assertEqual(self._names(3), ['second', 'minute', 'none'])
+
+    def test_priority_first(self):
+        now = time.monotonic()
+        self.queue.put(pycron.Task(self.foo.tick, ['second'], deadline=now + 1))
+        self.queue.put(pycron.Task(self.foo.tick, ['urgent'], priority=-1, deadline=now + 60))
+        self.assertEqual(self._names(2), ['urgent', 'second'])
+
+    def test_drop_stale(self):
+        now = time.monotonic()
+        self.queue.put(pycron.Task(self.foo.tick, ['stale'], deadline=now - 1))
+        self.queue.put(pycron.Task(self.foo.tick, ['fresh'], deadline=now + 1))
+        self.assertEqual(self._names(1), ['fresh'])
+        self.assertEqual(self.queue.dropped, {'Bot.tick': 1})
+
+    def test_drop_stale_delayed(self):
+        self.queue.put(pycron.Task(self.foo.tick, ['late'], deadline=time.monotonic() + 1), delay=2)
+        self.assertEqual(self.queue.qsize(), 0)
+        self.assertEqual(self.queue.dropped, {'Bot.tick': 1})
+
+    def test_sentinel_last(self):
+        self.queue.put(None)
+        self.queue.put(pycron.Task(self.foo.tick, ['task']))
+        self.assertEqual(self._names(1), ['task'])
+        self.assertEqual(self.queue.get(), None)
+
+class TestKeyedTaskQueue(unittest.TestCase):
+    def setUp(self):
+        self.queue = pycron.KeyedTaskQueue()
+        self.foo = Bot('foo')
+        self.bar = Bot('bar')
+
+    def test_serial_per_bot(self):
+        self.queue.put(pycron.Task(self.foo.tick, [1]))
+        self.queue.put(pycron.Task(self.foo.tock, [2]))
+        self.queue.put(pycron.Task(self.bar.tick, [3]))
+        first = self.queue.get()
+        self.assertEqual(first.args, [1])
+        self.assertEqual(self.queue.get().args, [3])
+        self.assertEqual(self.queue.depth(), {'foo': 1})
+        self.queue.done(first)
+        self.assertEqual(self.queue.get().args, [2])
+        self.assertGreater(self.queue.blocked['foo'], 0)
+        self.assertEqual(self.queue.max_depth['foo'], 2)
+
+    def test_busy_bot_waits(self):
+        self.queue.put(pycron.Task(self.foo.tick, [1]))
+        self.queue.put(pycron.Task(self.foo.tick, [2]))
+        first = self.queue.get()
+        threading.Timer(0.05, self.queue.done, [first]).start()
+        started = time.monotonic()
+        self.assertEqual(self.queue.get().args, [2])
+        self.assertGreaterEqual(time.monotonic() - started, 0.04)
+
+    def test_unowned_not_serialized(self):
+        def tick(t):
+            pass
+        self.queue.put(pycron.Task(tick, [1]))
+        self.queue.put(pycron.Task(tick, [2]))
+        self.assertEqual([ self.queue.get().args for _ in range(2) ], [[1], [2]])
+
+    def test_concurrent_not_serialized(self):
+        self.foo.TASK_CONCURRENT = ('tock',)
+        self.queue.put(pycron.Task(self.foo.tick, [1]))
+        self.queue.put(pycron.Task(self.foo.tock, [2]))
+        self.queue.put(pycron.Task(self.foo.tock, [3]))
+        self.assertEqual([ self.queue.get().args for _ in range(3) ], [[1], [2], [3]])
+
+    def test_sentinel_after_free_tasks(self):
+        self.queue.put(pycron.Task(self.foo.tick, [1]))
+        self.queue.put(pycron.Task(self.foo.tick, [2]))
+        self.queue.put(None)
+        self.queue.put(None)
+        first = self.queue.get()
+        self.assertIsNone(self.queue.get())
+        self.queue.done(first)
+        self.assertEqual(self.queue.get().args, [2])
+        self.assertIsNone(self.queue.get())
+
+class Flaky(Bot):
+    def __init__(self, name, failures):
+        super(Flaky, self).__init__(name)
+        self.log = mock.Mock()
+        self.failures = failures
+        self.calls = 0
+
+    @twitter.retry
+    def post(self, t):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise twitter.FailWhale('down')
+        return True
+
+class TestExecutorRetry(unittest.TestCase):
+    def setUp(self):
+        self.executor = pycron.CronExecutor()
+        self.executor.queue = mock.Mock()
+        self.executor.queue.get.side_effect = self._get
+        self.tasks = []
+
+    def _get(self):
+        return self.tasks.pop(0) if self.tasks else None
+
+    def _run(self, task):
+        self.tasks.append(task)
+        with mock.patch('threading.Thread', lambda name, target: mock.Mock(start=target)):
+            self.executor.run()
+
+    def test_reschedule_instead_of_sleep(self):
+        bot = Flaky('flaky', 1)
+        with mock.patch('time.sleep') as sleep:
+            self._run(pycron.Task(bot.post, [None]))
+            self.assertFalse(sleep.called)
+        self.assertEqual(bot.calls, 1)
+        (task,), kwargs = self.executor.queue.put.call_args
+        self.assertEqual((task.action, task.attempt), (bot.post, 2))
+        self.assertGreater(kwargs['delay'], 0)
+        self._run(task)
+        self.assertEqual(bot.calls, 2)
+        self.assertEqual(self.executor.retried, 1)
+
+    def test_give_up(self):
+        bot = Flaky('flaky', 10)
+        self._run(pycron.Task(bot.post, [None], attempt=twitter.RETRIES))
+        self.assertEqual(bot.calls, 1)
+        self.assertFalse(self.executor.queue.put.called)
+
+    def test_rate_limit_wait(self):
+        bot = Flaky('flaky', 0)
+        bot.post = twitter.retry(mock.Mock(side_effect=twitter.RateLimited('slow down', 600))).__get__(bot)
+        self._run(pycron.Task(bot.post, [None]))
+        self.assertGreaterEqual(self.executor.queue.put.call_args[1]['delay'], 600)
+
+    def test_outside_executor_blocks(self):
+        bot = Flaky('flaky', 2)
+        with mock.patch('time.sleep') as sleep:
+            self.assertTrue(bot.post(None))
+        self.assertEqual(sleep.call_count, 2)
@@ -57,3 +57,16 @@ class TestRobotZooUTC(unittest.TestCase):
         t = self._time('2038-01-19T03:14:07Z')
         result = list(self.cron_utc.get_runnable_actions(t))
         self.assertEqual(result, [robot_zoo.y2k38warning.zero])
+
+class TestCreateRunners(unittest.TestCase):
+    def test_empty_table_not_started(self):
+        from robot_zoo import __main__ as main
+        class DeOldehove(object):
+            name = 'deoldehove'
+            def sound_clock(self, t):
+                pass
+            sound_clock_lwd_culinair = sound_clock_into_the_grave = sound_clock
+        queue = mock.Mock()
+        with mock.patch.dict(main.bots, {'deoldehove': DeOldehove()}, clear=True):
+            runners = main.create_runners(queue)
+        self.assertEqual([ (runner.name, runner.queue) for runner in runners ], [('cron_cet', queue)])
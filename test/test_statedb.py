@@ -0,0 +1,94 @@
+import json
+import os
+import tempfile
+import threading
+import unittest
+
+import mock
+
+from robot_zoo import statedb
+from robot_zoo import twitter
+
+class TestDBConfiguration(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.db = statedb.StateDB(os.path.join(self.dir.name, 'robot_zoo.db'))
+        self.config = self._config('casio_f91w')
+
+    def tearDown(self):
+        self.db.close()
+        self.dir.cleanup()
+
+    def _config(self, bot, **kwargs):
+        return statedb.DBConfiguration(self.db, bot, mock.Mock(), default=lambda: {'last_mention': None}, **kwargs)
+
+    def test_default(self):
+        self.assertIsNone(self.config['last_mention'])
+        with self.assertRaises(KeyError):
+            self.config['spam']
+
+    def test_save_load(self):
+        self.config['last_mention'] = '42'
+        self.config['cursor'] = ['1', '2']
+        self.config.save()
+        config = self._config('casio_f91w')
+        self.assertEqual((config['last_mention'], config['cursor']), ('42', ['1', '2']))
+        self.assertIsNone(self._config('other')['last_mention'])
+
+    def test_changed_keys_only(self):
+        self.config['a'] = {'b': 1}
+        self.config['c'] = 2
+        self.config.save()
+        self.config['a']['b'] = 3
+        with mock.patch.object(self.db, 'put', wraps=self.db.put) as put:
+            self.config.save()
+            put.assert_called_once_with('casio_f91w', [('a', '{"b": 3}')])
+            self.config.save()
+            self.assertEqual(put.call_count, 1)
+
+    def test_transaction_across_bots(self):
+        other = self._config('maanfase')
+        with self.assertRaises(ZeroDivisionError):
+            with self.db.transaction():
+                self.config['last_mention'] = '1'
+                self.config.save()
+                other['year'] = 2038
+                other.save()
+                1 / 0
+        self.assertEqual(self.db.keys('casio_f91w'), [])
+        with self.db.transaction():
+            self.config.save()
+            other.save()
+        self.assertEqual(self.db.keys('maanfase'), ['year'])
+
+    def test_concurrent_reader(self):
+        self.config['last_mention'] = '1'
+        self.config.save()
+        seen = []
+        with self.db.transaction():
+            self.config['last_mention'] = '2'
+            self.config.save()
+            reader = threading.Thread(target=lambda: seen.append(self.db.get('casio_f91w', 'last_mention')))
+            reader.start()
+            reader.join()
+        self.assertEqual(seen, ['"1"'])
+        self.assertEqual(self.db.get('casio_f91w', 'last_mention'), '"2"')
+
+    def test_migrate(self):
+        path = os.path.join(self.dir.name, 'deoldehove.state.json')
+        with open(path, 'w') as f:
+            json.dump({'last_mention': '7', 'alarms': {}}, f)
+        config = self._config('deoldehove', config_file=path)
+        self.assertEqual(config['last_mention'], '7')
+        self.assertFalse(os.path.exists(path))
+        self.assertTrue(os.path.exists(path + '.migrated'))
+
+class TestOpenState(unittest.TestCase):
+    def test_read_only(self):
+        with tempfile.TemporaryDirectory() as d:
+            with open(os.path.join(d, 'deoldehove.state.json'), 'w') as f:
+                json.dump({'last_mention': '7'}, f)
+            with mock.patch.dict(os.environ, {'ROBOT_ZOO_STATE_DIR': d}), mock.patch.object(twitter, 'READ_ONLY', True):
+                state = twitter.open_state('deoldehove', mock.Mock())
+            self.assertEqual(state['last_mention'], '7')
+            self.assertEqual(os.listdir(d), ['deoldehove.state.json'])
@@ -1,3 +1,7 @@
+import json
+import os
+import tempfile
+import threading
 import time
 import unittest
 
@@ -5,6 +9,7 @@ import mock
 
 from robot_zoo import twitter
 from robot_zoo import oauth1
+from robot_zoo import ratelimit
 
 class TestRetry(unittest.TestCase):
     @twitter.retry
@@ -60,3 +65,324 @@ class TestTwitterAPI(unittest.TestCase):
                 'https://api.twitter.com/1.1/statuses/update.json',
                 headers={'Accept': 'application/json'},
                 post={'status': b'test'})
+
+class TestTwitterAPIClient(unittest.TestCase):
+    def setUp(self):
+        self.api = twitter.TwitterAPI('johndoeveloper')
+        self.api.config.config = {'oauth': {'consumer_key': 'key'}}
+        self.api.rate_limiter = ratelimit.RateLimiter()
+
+    def test_client_reused(self):
+        with mock.patch('robot_zoo.oauth1.Oauth1') as Oauth1:
+            self.api.post_statuses_update(status='1')
+            self.api.post_statuses_update(status='2')
+            self.assertEqual(Oauth1.call_count, 1)
+            self.assertEqual(Oauth1.return_value.request.call_count, 2)
+            self.assertEqual(self.api.client_busy, 0)
+
+    def test_idle_client_closed(self):
+        with mock.patch('robot_zoo.oauth1.Oauth1') as Oauth1:
+            self.api.post_statuses_update(status='1')
+            self.api.client_used -= self.api.POOL_IDLE + 1
+            self.api.post_statuses_update(status='2')
+            self.assertEqual(Oauth1.call_count, 2)
+            Oauth1.return_value.session.close.assert_called_once_with()
+
+    def test_busy_client_not_closed(self):
+        with mock.patch('robot_zoo.oauth1.Oauth1') as Oauth1:
+            client = self.api.acquire_client()
+            self.api.client_used -= self.api.POOL_IDLE + 1
+            self.assertIs(self.api.acquire_client(), client)
+            self.assertFalse(client.session.close.called)
+
+    def test_replaced_client_closed_when_released(self):
+        with mock.patch('robot_zoo.oauth1.Oauth1') as Oauth1:
+            client = self.api.acquire_client()
+            self.api.config_reloaded({'oauth': {'consumer_key': 'key'}}, {'oauth': {'consumer_key': 'other'}})
+            self.assertFalse(client.session.close.called)
+            Oauth1.return_value = mock.Mock()
+            self.assertIsNot(self.api.acquire_client(), client)
+            self.api.release_client(client)
+            client.session.close.assert_called_once_with()
+            self.assertEqual((self.api.client_busy, self.api.retired), (1, {}))
+
+class TestEndpoint(unittest.TestCase):
+    def test_metadata(self):
+        endpoint = twitter.TwitterAPI.endpoint('post_statuses_update')
+        self.assertEqual(endpoint.method, 'POST')
+        self.assertEqual(endpoint.path, 'statuses/update')
+        self.assertEqual(endpoint.bucket, '/statuses/update')
+        self.assertFalse(endpoint.stream)
+        self.assertEqual(endpoint.url(), 'https://api.twitter.com/1.1/statuses/update.json')
+
+    def test_url_args(self):
+        endpoint = twitter.TwitterAPI.endpoint('get_statuses_show')
+        self.assertEqual(endpoint.url((123, '')), 'https://api.twitter.com/1.1/statuses/show/123.json')
+
+    def test_per_class(self):
+        self.assertEqual(twitter.StreamAPI.endpoint('get_statuses_filter').url(), 'https://stream.twitter.com/1.1/statuses/filter.json')
+        self.assertEqual(twitter.UserStreamAPI.endpoint('get_user').url(), 'https://userstream.twitter.com/1.1/user.json')
+        self.assertTrue(twitter.UserStreamAPI.endpoint('get_user').stream)
+        with self.assertRaises(AttributeError):
+            twitter.StreamAPI.endpoint('post_account_update_profile')
+
+    def test_caller_cached(self):
+        api = twitter.TwitterAPI('johndoeveloper')
+        self.assertIs(api.post_statuses_update, api.post_statuses_update)
+        self.assertIs(api.post_statuses_update.endpoint, twitter.TwitterAPI.endpoint('post_statuses_update'))
+
+class TestStream(unittest.TestCase):
+    def split(self, data, size, delimited=False):
+        return list(twitter.split_messages((data[i:i + size] for i in range(0, len(data), size)), delimited))
+
+    def test_lines(self):
+        data = b'{"a": 1}\r\n\r\n{"b": 2}\r\n\r\n'
+        for size in (1, 2, 3, 7, len(data)):
+            self.assertEqual(self.split(data, size), [b'{"a": 1}', b'', b'{"b": 2}', b''])
+        self.assertEqual(self.split(b'{"a": 1}\n{"b"', 4), [b'{"a": 1}', b'{"b"'])
+
+    def test_delimited(self):
+        data = b'\r\n10\r\n{"a": 1}\r\n\r\n12\r\n{"b": "\n"}\r\n12\r\n{"c"'
+        for size in (1, 5, len(data)):
+            self.assertEqual(self.split(data, size, delimited=True), [b'', b'{"a": 1}', b'', b'{"b": "\n"}'])
+
+    def test_call(self):
+        api = twitter.StreamAPI('johndoeveloper')
+        api.config.config = {'oauth': {'consumer_key': 'key'}}
+        api.rate_limiter = ratelimit.RateLimiter()
+        with mock.patch('robot_zoo.oauth1.Oauth1') as Oauth1:
+            raw = Oauth1.return_value.request.return_value.raw
+            raw.read1.side_effect = [ b'{"id": 1}\r', b'\n\r\n{"id"', b': 2}\r\n', b'' ]
+            self.assertEqual(list(api.get_statuses_sample()), [{'id': 1}, b'', {'id': 2}])
+            raw.read1.assert_called_with(api.STREAM_BUFFER, decode_content=True)
+
+    def test_client_busy_while_streaming(self):
+        api = twitter.StreamAPI('johndoeveloper')
+        api.config.config = {'oauth': {'consumer_key': 'key'}}
+        api.rate_limiter = ratelimit.RateLimiter()
+        with mock.patch('robot_zoo.oauth1.Oauth1') as Oauth1:
+            Oauth1.return_value.request.return_value.raw.read1.side_effect = [ b'{"id": 1}\r\n', b'' ]
+            messages = api.get_statuses_sample()
+            self.assertEqual(next(messages), {'id': 1})
+            api.client_used -= api.POOL_IDLE + 1
+            Oauth1.return_value.request.side_effect = ValueError
+            with self.assertRaises(twitter.FailWhale):
+                api.get_statuses_sample()
+            self.assertEqual((Oauth1.call_count, api.client_busy), (1, 1))
+            self.assertFalse(Oauth1.return_value.session.close.called)
+            messages.close()
+            self.assertEqual(api.client_busy, 0)
+
+class TestRateLimit(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000
+        self.api = twitter.TwitterAPI('johndoeveloper')
+        self.api.config.config = {'oauth': {'consumer_key': 'key'}}
+        self.api.rate_limiter = ratelimit.RateLimiter(get_time=lambda: self.now)
+
+    def _headers(self, remaining, reset):
+        return {'x-rate-limit-limit': '75', 'x-rate-limit-remaining': str(remaining), 'x-rate-limit-reset': str(reset)}
+
+    def test_headers_recorded(self):
+        with mock.patch('robot_zoo.oauth1.Oauth1') as Oauth1:
+            Oauth1.return_value.request.return_value.headers = self._headers(74, 1900)
+            self.api.get_statuses_mentions_timeline(count=200)
+        self.assertEqual(self.api.rate_limit('get_statuses_mentions_timeline'), (75, 74, 1900))
+
+    def test_wait_for_reset(self):
+        self.api.rate_limiter.update(('@johndoeveloper', '/statuses/mentions_timeline'), self._headers(0, 1030))
+        with mock.patch('robot_zoo.oauth1.Oauth1') as Oauth1, mock.patch('time.sleep') as sleep:
+            sleep.side_effect = lambda t: setattr(self, 'now', self.now + t)
+            self.api.get_statuses_mentions_timeline(count=200)
+            sleep.assert_called_once_with(30)
+            self.assertTrue(Oauth1.return_value.request.called)
+
+    def test_executor_not_blocked(self):
+        self.api.rate_limiter.update(('@johndoeveloper', '/statuses/mentions_timeline'), self._headers(0, 1030))
+        twitter.worker.attempt = 1
+        try:
+            with mock.patch('robot_zoo.oauth1.Oauth1') as Oauth1, mock.patch('time.sleep') as sleep:
+                with self.assertRaises(twitter.RateLimited) as e:
+                    self.api.get_statuses_mentions_timeline(count=200)
+                self.assertFalse(sleep.called)
+                self.assertFalse(Oauth1.return_value.request.called)
+        finally:
+            twitter.worker.attempt = None
+        self.assertEqual(e.exception.wait, 30)
+
+    def test_long_wait_raises(self):
+        self.api.rate_limiter.update(('@johndoeveloper', '/statuses/mentions_timeline'), self._headers(0, 1900))
+        with mock.patch('robot_zoo.oauth1.Oauth1') as Oauth1:
+            with self.assertRaises(twitter.RateLimited):
+                self.api.get_statuses_mentions_timeline(count=200)
+            self.assertFalse(Oauth1.return_value.request.called)
+
+    def test_config_error_is_failwhale(self):
+        self.api.config.config = {}
+        with mock.patch('robot_zoo.oauth1.Oauth1'):
+            with self.assertRaises(twitter.FailWhale) as e:
+                self.api.post_statuses_update(status='1')
+        self.assertIsInstance(e.exception.args[1], KeyError)
+
+    def test_app_budget_shared(self):
+        other = twitter.TwitterAPI('casio_f91w')
+        other.config.config = {'oauth': {'consumer_key': 'key'}}
+        other.rate_limiter = self.api.rate_limiter
+        self.api.rate_limiter.budget(('key', '/statuses/update'), 2, 3600)
+        with mock.patch('robot_zoo.oauth1.Oauth1'):
+            self.api.post_statuses_update(status='1')
+            other.post_statuses_update(status='2')
+            with self.assertRaises(twitter.RateLimited):
+                other.post_statuses_update(status='3')
+        self.assertEqual(self.api.rate_limiter.state(('key', '/statuses/update')), (2, 0, 4600))
+
+class TestConfiguration(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'test.state.json')
+        self.config = twitter.Configuration(self.path, mock.Mock(), default=lambda: {'n': 0}, delay=0.05)
+
+    def tearDown(self):
+        twitter.flush()
+        self.dir.cleanup()
+
+    def _load(self):
+        with open(self.path) as f:
+            return json.load(f)
+
+    def test_coalesced(self):
+        with mock.patch('robot_zoo.twitter.write_atomic', wraps=twitter.write_atomic) as write:
+            for i in range(10):
+                self.config['n'] = i
+                self.config.save()
+            self.assertFalse(os.path.exists(self.path))
+            time.sleep(0.2)
+        self.assertEqual(write.call_count, 1)
+        self.assertEqual(self._load(), {'n': 9})
+        self.assertEqual(os.listdir(self.dir.name), ['test.state.json'])
+
+    def test_flush(self):
+        self.config['n'] = 1
+        self.config.save()
+        twitter.flush()
+        self.assertEqual(self._load(), {'n': 1})
+
+    def test_unchanged_not_written(self):
+        self.config.save()
+        twitter.flush()
+        with mock.patch('robot_zoo.twitter.write_atomic') as write:
+            self.config.save()
+            twitter.flush()
+        self.assertFalse(write.called)
+
+    def test_failed_write_keeps_file(self):
+        self.config.save()
+        twitter.flush()
+        self.config['n'] = 1
+        self.config.save()
+        with mock.patch('os.fsync', side_effect=OSError('disk full')):
+            with self.assertRaises(OSError):
+                self.config.flush()
+        self.assertEqual(self._load(), {'n': 0})
+
+class TestConfigurationReload(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'deoldehove.json')
+        self._write({'oauth': {'consumer_key': 'key'}, 'default': {'sound': 'BONG'}})
+        self.config = twitter.Configuration(self.path, mock.Mock(), delay=0)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def _write(self, config):
+        with open(self.path + '.new', 'w') as f:
+            json.dump(config, f)
+        os.replace(self.path + '.new', self.path)
+
+    def test_reload(self):
+        listener = mock.Mock()
+        self.config.on_reload(listener)
+        sounds = self.config['default']
+        self.assertFalse(self.config.reload())
+        self._write({'oauth': {'consumer_key': 'key'}, 'default': {'sound': 'BANG'}})
+        self.assertTrue(self.config.reload())
+        self.assertEqual(self.config['default'], {'sound': 'BANG'})
+        self.assertEqual(sounds, {'sound': 'BONG'})
+        listener.assert_called_once_with(mock.ANY, self.config.config)
+
+    def test_broken_file_ignored(self):
+        with open(self.path, 'w') as f:
+            f.write('{"default": ')
+        self.assertFalse(self.config.reload())
+        self.assertEqual(self.config['default'], {'sound': 'BONG'})
+
+    def test_own_save_not_reloaded(self):
+        self.config['default'] = {'sound': 'BANG'}
+        self.config.save()
+        self.assertFalse(self.config.reload())
+
+    def test_watcher(self):
+        watcher = twitter.Watcher()
+        watcher.watch(self.config)
+        self._write({'default': {}})
+        watcher.poll()
+        self.assertEqual(self.config['default'], {})
+
+    def test_credentials_rebuild_client(self):
+        api = twitter.TwitterAPI('deoldehove')
+        api.config = self.config
+        self.config.on_reload(api.config_reloaded)
+        client = api.acquire_client()
+        api.release_client(client)
+        self._write({'oauth': {'consumer_key': 'key'}, 'default': {'sound': 'BANG'}})
+        self.config.reload()
+        self.assertIs(api.acquire_client(), client)
+        api.release_client(client)
+        self._write({'oauth': {'consumer_key': 'other'}, 'default': {'sound': 'BANG'}})
+        self.config.reload()
+        self.assertIsNot(api.acquire_client(), client)
+
+class TestCheckAccounts(unittest.TestCase):
+    def setUp(self):
+        self.apis = [ self._api(name) for name in ['casio_f91w', 'deoldehove', 'maanfase'] ]
+        self.state = mock.MagicMock()
+        self.state.__getitem__.return_value = self.checks = {}
+
+    def _api(self, name):
+        api = mock.Mock()
+        api.name = name
+        api.config = {'oauth': {'token': name}}
+        return api
+
+    def test_concurrent(self):
+        barrier = threading.Barrier(3, timeout=5)
+        for api in self.apis:
+            api.check.side_effect = barrier.wait
+        self.assertEqual(twitter.check_accounts(self.apis, self.state), {})
+        self.assertEqual(sorted(self.checks), ['casio_f91w', 'deoldehove', 'maanfase'])
+        self.state.save.assert_called_once_with()
+
+    def test_failure(self):
+        error = twitter.FailWhale('Unauthorized')
+        self.apis[1].check.side_effect = error
+        self.assertEqual(twitter.check_accounts(self.apis, self.state), {self.apis[1]: error})
+        self.assertNotIn('deoldehove', self.checks)
+
+    def test_cached_rechecked(self):
+        twitter.check_accounts(self.apis, self.state)
+        self.apis[0].config['oauth']['token'] = 'other'
+        error = twitter.FailWhale('Unauthorized')
+        self.apis[2].check.side_effect = error
+        failed = threading.Event()
+        on_fail = mock.Mock(side_effect=lambda api, e: failed.set())
+        self.assertEqual(twitter.check_accounts(self.apis, self.state, on_fail), {})
+        self.assertTrue(failed.wait(5))
+        on_fail.assert_called_once_with(self.apis[2], error)
+        self.assertEqual([ api.check.call_count for api in self.apis ], [2, 2, 2])
+
+    def test_expired(self):
+        twitter.check_accounts(self.apis, self.state)
+        self.apis[0].check.side_effect = twitter.FailWhale('Unauthorized')
+        with mock.patch('time.time', return_value=time.time() + twitter.CHECK_TTL):
+            self.assertEqual(list(twitter.check_accounts(self.apis, self.state)), [self.apis[0]])
@@ -4,6 +4,7 @@ import unittest
 
 import mock
 
+from robot_zoo import pycron
 from robot_zoo import twitter
 from robot_zoo.bot import y2k38warning
 
@@ -84,6 +85,14 @@ class TestY2K38Warning(unittest.TestCase):
         self.api.post_statuses_update.assert_called_once_with(
             status='Y2K38 is here! Watch out for falling airplanes!')
 
+    def test_every_second_not_serialized(self):
+        # a slow post mustn't hold up the next second's past its 1 s deadline
+        queue = pycron.KeyedTaskQueue()
+        for sec in range(3):
+            queue.put(pycron.Task(self.y2k38warning.every_second, [self._time(f'2038-01-19T03:14:0{sec}Z')], deadline=time.monotonic() + 1))
+        queue.put(pycron.Task(self.y2k38warning.zero, [self._time('2038-01-19T03:14:07Z')]))
+        self.assertEqual([ queue.get().args[0].tm_sec for _ in range(4) ], [0, 1, 2, 7])
+
 class Y2K38WarningFail(unittest.TestCase):
     def setUp(self):
         self.api = mock.Mock()